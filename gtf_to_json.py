@@ -3,6 +3,8 @@ import itertools
 from joblib import delayed,Parallel
 import gffutils
 import json
+import hashlib
+import os
 import argparse
 
 def intervals_extract(iterable):
@@ -36,6 +38,46 @@ def create_interval_dict_linear_time(gene,isoform_interval_dict):
         d[interval(intervals_extract(coords))] = set(eval(s))
     return gene, d
 
+def intron_chains(exon_list, max_chain_length):
+    exon_list = sorted(exon_list)
+    chains = {}
+    for a in range(len(exon_list)-1):
+        for b in range(a, min(len(exon_list)-1, a+max_chain_length)):
+            chain = ','.join(['{}-{}'.format(exon_list[i][1]+1, exon_list[i+1][0]-1) for i in range(a, b+1)])
+            chains[chain] = (exon_list[a][0], exon_list[b+1][1])
+    return chains
+
+def create_intron_chain_dict(gene, isoform_exon_dict, max_chain_length):
+    d = {}
+    for transcript, exon_list in isoform_exon_dict.items():
+        for chain, (start, end) in intron_chains(exon_list, max_chain_length).items():
+            if chain in d:
+                d[chain][0] = max(d[chain][0], start)
+                d[chain][1] = min(d[chain][1], end)
+                d[chain][2].add(transcript)
+            else:
+                d[chain] = [start, end, {transcript}]
+    # stitcher.py ignores overlaps of up to 4 bases in the interval lookup, so a chain is only kept if no other exon boundary
+    # falls within 7 bases of its introns and no transcript without the chain has an intron boundary there.
+    points = {p for exon_list in isoform_exon_dict.values() for e in exon_list for p in e}
+    boundaries = {}
+    for transcript, exon_list in isoform_exon_dict.items():
+        exon_list = sorted(exon_list)
+        boundaries[transcript] = {b for i in range(len(exon_list)-1) for b in (exon_list[i][1]+1, exon_list[i+1][0]-1)}
+    chain_dict = {}
+    for chain, v in d.items():
+        introns = [[int(b) for b in intron.split('-')] for intron in chain.split(',')]
+        own = {p for s, e in introns for p in (s-1, e+1)}
+        near = [p for s, e in introns for c in (s, e) for p in range(c-7, c+8) if p != c]
+        if any([p in points and p not in own for p in near]) or any([p in boundaries[t] for t in boundaries if t not in v[2] for p in near]):
+            continue
+        chain_dict[chain] = [v[0], v[1], ','.join(sorted(v[2]))]
+    return gene, chain_dict
+
+def gene_model_hash(strand, exon_dict):
+    model = [strand, sorted([transcript, [list(e) for e in exon_list]] for transcript, exon_list in exon_dict.items())]
+    return hashlib.sha1(json.dumps(model).encode()).hexdigest()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Write json file used for stitcher.py from a gtf file')
@@ -43,44 +85,82 @@ if __name__ == '__main__':
     parser.add_argument('-d','--db', metavar='db', type=str, help='Intermediary database (db) file')
     parser.add_argument('-ji','--json_intervals', metavar='json', type=str, help='Output json file for coverage')
     parser.add_argument('-jr','--json_refskip', metavar='json', type=str, help='Output json file for refskip')
+    parser.add_argument('-jc','--json_chains', metavar='json', type=str, default=None, help='Output json file for intron chains (optional)')
+    parser.add_argument('-mc','--max_chain_length', metavar='max_chain_length', type=int, default=5, help='Longest intron chain (number of introns) written to the intron chain json file')
+    parser.add_argument('-c','--cache', metavar='cache', type=str, default=None, help='Cache json file with the results per gene from a previous run, genes with an unchanged transcript model are reused (created if missing)')
     parser.add_argument('-t', '--threads', metavar='threads', type=int, default=1, help='Number of threads')
     args = parser.parse_args()
     gtffile = args.gtf
     dbfile = args.db
     jsonfile_1 = args.json_intervals
     jsonfile_2 = args.json_refskip
+    jsonfile_3 = args.json_chains
+    max_chain_length = args.max_chain_length
+    cachefile = args.cache
     threads = int(args.threads)
     print('Creating gtf database, this will take some time...')
     db = gffutils.create_db(gtffile, dbfile)
     isoform_interval_dict = {}
     isoform_refskip_dict = {}
+    isoform_exon_dict = {}
+    gene_hash = {}
     for gene in db.features_of_type('gene'):
         g_id = gene['gene_id'][0]
         isoform_interval_dict[g_id] = {}
         isoform_refskip_dict[g_id] = {}
+        isoform_exon_dict[g_id] = {}
         for transcript in db.children(gene, featuretype='transcript'):
             t_id = transcript['transcript_id'][0]
             isoform_interval_dict[g_id][t_id] = P.empty()
             isoform_refskip_dict[g_id][t_id] = P.empty()
-            for exon in db.children(transcript, featuretype='exon'):
-                isoform_interval_dict[g_id][t_id] = isoform_interval_dict[g_id][t_id] | P.closed(exon.start,exon.end)
-            exon_list = [exon for exon in db.children(transcript, featuretype='exon')]
-            if gene.strand == '+':
-                for i in range(len(exon_list)-1):
-                    isoform_refskip_dict[g_id][t_id] = isoform_refskip_dict[g_id][t_id] | P.closed(exon_list[i].end,exon_list[i+1].start)
-            else:
-                for i in range(len(exon_list)-1):
-                    isoform_refskip_dict[g_id][t_id] = isoform_refskip_dict[g_id][t_id] | P.closed(exon_list[i+1].end,exon_list[i].start)
+            # gffutils does not return the exons in order, sort them so the refskip intervals match the intron chains
+            exon_list = sorted([(exon.start, exon.end) for exon in db.children(transcript, featuretype='exon')])
+            isoform_exon_dict[g_id][t_id] = exon_list
+            for start, end in exon_list:
+                isoform_interval_dict[g_id][t_id] = isoform_interval_dict[g_id][t_id] | P.closed(start, end)
+            for i in range(len(exon_list)-1):
+                isoform_refskip_dict[g_id][t_id] = isoform_refskip_dict[g_id][t_id] | P.closed(exon_list[i][1], exon_list[i+1][0])
+        gene_hash[g_id] = gene_model_hash(gene.strand, isoform_exon_dict[g_id])
+    cache = {}
+    if cachefile is not None and os.path.exists(cachefile):
+        with open(cachefile) as fp:
+            cache = json.load(fp)
+    unchanged = {g_id for g_id, h in gene_hash.items() if g_id in cache and cache[g_id]['hash'] == h}
+    if cachefile is not None:
+        print('Reusing {} of {} genes from cache {}'.format(len(unchanged), len(gene_hash), cachefile))
     print('Extracting unque isoform intervals')
-    res = Parallel(n_jobs=threads, verbose = 3, backend='loky')(delayed(create_interval_dict_linear_time)(gene, transcript_intervals) for gene, transcript_intervals in isoform_interval_dict.items())
+    res = Parallel(n_jobs=threads, verbose = 3, backend='loky')(delayed(create_interval_dict_linear_time)(gene, transcript_intervals) for gene, transcript_intervals in isoform_interval_dict.items() if gene not in unchanged)
     isoform_unique_intervals = {k:v for k,v in res}
-    isoform_unique_intervals_for_json_dump = {gene: {P.to_string(k):','.join(v) for k,v in d.items()} for gene,d in isoform_unique_intervals.items()}
-    res_2 = Parallel(n_jobs=threads, verbose = 3, backend='loky')(delayed(create_interval_dict_linear_time)(gene, transcript_intervals) for gene, transcript_intervals in isoform_refskip_dict.items())
+    isoform_unique_intervals_for_json_dump = {gene: {P.to_string(k):','.join(v) for k,v in isoform_unique_intervals[gene].items()} if gene not in unchanged else cache[gene]['intervals'] for gene in gene_hash}
+    res_2 = Parallel(n_jobs=threads, verbose = 3, backend='loky')(delayed(create_interval_dict_linear_time)(gene, transcript_intervals) for gene, transcript_intervals in isoform_refskip_dict.items() if gene not in unchanged)
     isoform_unique_refskip = {k:v for k,v in res_2}
-    isoform_unique_refskip_for_json_dump = {gene: {P.to_string(k):','.join(v) for k,v in d.items()} for gene,d in isoform_unique_refskip.items()}
+    isoform_unique_refskip_for_json_dump = {gene: {P.to_string(k):','.join(v) for k,v in isoform_unique_refskip[gene].items()} if gene not in unchanged else cache[gene]['refskip'] for gene in gene_hash}
     print('Writing unique isoform intervals to json file {}'.format(jsonfile_1))
     with open(jsonfile_1, 'w') as fp:
         json.dump(isoform_unique_intervals_for_json_dump, fp)
     print('Writing unique isoform refskip to json file {}'.format(jsonfile_2))
     with open(jsonfile_2, 'w') as fp:
         json.dump(isoform_unique_refskip_for_json_dump, fp)
+    isoform_intron_chains = None
+    if jsonfile_3 is not None:
+        print('Extracting intron chains')
+        cached_chains = {g_id for g_id in unchanged if cache[g_id].get('max_chain_length') == max_chain_length}
+        res_3 = Parallel(n_jobs=threads, verbose = 3, backend='loky')(delayed(create_intron_chain_dict)(gene, exon_lists, max_chain_length) for gene, exon_lists in isoform_exon_dict.items() if gene not in cached_chains)
+        isoform_intron_chains = {k:v for k,v in res_3}
+        isoform_intron_chains = {gene: isoform_intron_chains[gene] if gene not in cached_chains else cache[gene]['chains'] for gene in gene_hash}
+        print('Writing intron chains to json file {}'.format(jsonfile_3))
+        with open(jsonfile_3, 'w') as fp:
+            json.dump(isoform_intron_chains, fp)
+    if cachefile is not None:
+        new_cache = {}
+        for gene, h in gene_hash.items():
+            new_cache[gene] = {'hash': h, 'intervals': isoform_unique_intervals_for_json_dump[gene], 'refskip': isoform_unique_refskip_for_json_dump[gene]}
+            if isoform_intron_chains is not None:
+                new_cache[gene]['chains'] = isoform_intron_chains[gene]
+                new_cache[gene]['max_chain_length'] = max_chain_length
+            elif gene in unchanged and 'chains' in cache[gene]:
+                new_cache[gene]['chains'] = cache[gene]['chains']
+                new_cache[gene]['max_chain_length'] = cache[gene]['max_chain_length']
+        print('Writing cache to json file {}'.format(cachefile))
+        with open(cachefile, 'w') as fp:
+            json.dump(new_cache, fp)
@@ -14,6 +14,21 @@ import sys
 import time
 import os
 import json
+import zlib
+import gzip
+import heapq
+import queue
+import threading
+import tempfile
+import tracemalloc
+import cProfile
+import pstats
+import glob
+import resource
+import hashlib
+import struct
+import socket
+import stat
 from scipy.special import logsumexp
 from joblib import delayed,Parallel
 from multiprocessing import Process, Manager
@@ -34,7 +49,23 @@ ll_other_correct = {i:-(float(i)*np.log(10))/10 - ln_3 for i in range(1,94)}
 
 ll_N = -np.log(4)
 
-from scipy.sparse import csc_matrix
+from scipy.sparse import csc_matrix, coo_matrix, save_npz
+
+from scipy.io import mmwrite
+
+worker_cache = {}
+
+# seconds before idle loky workers (and their caches) are shut down, raised by the server to keep them warm
+
+worker_idle_timeout = 300
+
+# seconds between rewrites of a worker's profile with --profile, the rest is written by flush_worker_profile at the end of the run
+
+profile_dump_interval = 60
+
+# number of genes whose parsed isoform intervals a worker keeps, least recently used first out
+
+parsed_annotation_cache_size = 500
 
 def make_ll_array(e):
 
@@ -170,8 +201,264 @@ def using_indexed_assignment(x):
 
 
 
+def open_alignment_file(filename, mode, reference=None, threads=0, **kwargs):
+
+    # .cram files are read and written as CRAM, using the local reference fasta
+
+    if filename.endswith('.cram'):
+
+        if mode[0] == 'r':
+
+            # do not add MD/NM tags when decoding, the records should look the same as from a .bam file
+
+            kwargs['format_options'] = [b'decode_md=0']
+
+        return pysam.AlignmentFile(filename, mode[0]+'c', reference_filename=reference, threads=threads, **kwargs)
+
+    return pysam.AlignmentFile(filename, mode, threads=threads, **kwargs)
+
+
+
+def prepare_reference(reference, *filenames):
+
+    if not any([f.endswith('.cram') for f in filenames]):
+
+        return
+
+    if reference is None:
+
+        raise Exception('A reference fasta (--reference) is needed for .cram files.')
+
+    # index the fasta once here instead of in every worker
+
+    if not os.path.exists('{}.fai'.format(reference)):
+
+        pysam.faidx(reference)
+
+
+
+def call_bases(ll_sums):
+
+    full_ll = logsumexp(ll_sums, axis=0)
+
+    prob_max = np.asarray(np.exp(np.amax(ll_sums, axis=0) - full_ll)).ravel()
+
+    nuc_max = np.asarray(np.argmax(ll_sums, axis=0)).ravel()
+
+    seq = [nucleotides[x] if p > 0.3 else 'N' for p, x in zip(prob_max, nuc_max)]
+
+    phred = np.nan_to_num(np.rint(-10*np.log10(1-prob_max+1e-13)))
+
+    return seq, phred
+
+
+
+def make_single_base_table():
+
+    # called base and phred of a position covered by a single read, for every base and base quality
+
+    keys = [(b1, Q) for b1 in nucleotides + ['N'] for Q in ll_this_correct]
+
+    ll_sums = np.array([[ll_N if b1 == 'N' else ll_this_correct[Q] if b1 == b2 else ll_other_correct[Q] for b1, Q in keys] for b2 in nucleotides])
+
+    seq, phred = call_bases(ll_sums)
+
+    return dict(zip(keys, zip(seq, phred)))
+
+
+
+single_base_table = make_single_base_table()
+
+
+
+def stitch_single_read(read_d, single_end, cell, gene, umi, UMI_tag):
+
+    # UMI groups of one read or one read pair, gives the same molecule as the general path without the likelihood matrices and intervals
+
+    # returns None for anything the general path should handle
+
+    columns = {}
+
+    skipped_intervals = []
+
+    reverse_read1 = []
+
+    for read in read_d:
+
+        cigtuples = read.cigartuples
+
+        if any([c[0] > 5 for c in cigtuples]):
+
+            return None
+
+        try:
+
+            Q_list = list(read.query_alignment_qualities)
+
+        except TypeError:
+
+            return None
+
+        seq = read.query_alignment_sequence
+
+        insertion_locs = get_insertions_locs(cigtuples)
+
+        if len(insertion_locs) > 0:
+
+            seq = "".join([char for idx, char in enumerate(seq) if idx not in insertion_locs])
+
+            Q_list = [qual for idx, qual in enumerate(Q_list) if idx not in insertion_locs]
+
+        ref_positions = read.get_reference_positions()
+
+        if len(ref_positions) == 0:
+
+            return None
+
+        for s, e in get_skipped_tuples(cigtuples, ref_positions):
+
+            if s > e:
+
+                return None
+
+            skipped_intervals.append((s, e))
+
+        for b1, Q, pos in zip(seq, Q_list, ref_positions):
+
+            if (b1, Q) not in single_base_table:
+
+                return None
+
+            if pos in columns:
+
+                columns[pos].append((b1, Q))
+
+            else:
+
+                columns[pos] = [(b1, Q)]
+
+        if read.is_read1 and not single_end and read.get_tag(UMI_tag) != '':
+
+            reverse_read1.append(read.is_reverse)
+
+        elif single_end:
+
+            reverse_read1.append(read.is_reverse)
+
+    if len(reverse_read1) == 0:
+
+        return (False, ':'.join([gene,cell,umi]))
+
+    merged_skipped = []
+
+    for s, e in sorted(set(skipped_intervals)):
+
+        if len(merged_skipped) > 0 and s <= merged_skipped[-1][1]:
+
+            merged_skipped[-1][1] = max(merged_skipped[-1][1], e)
+
+        else:
+
+            merged_skipped.append([s, e])
+
+    positions = sorted(columns)
+
+    ref_tuples = list(intervals_extract(positions))
+
+    # mates disagreeing on an intron are left to the general path, which tags the conflict
+
+    for s, e in merged_skipped:
+
+        for r_s, r_e in ref_tuples:
+
+            if r_s <= e and s <= r_e:
+
+                return None
+
+    blocks = sorted([(s, e, 'M') for s, e in ref_tuples] + [(s, e, 'N') for s, e in merged_skipped])
+
+    CIGAR = ''
+
+    for n, (s, e, c) in enumerate(blocks):
+
+        if n > 0 and s - blocks[n-1][1] - 1 > 0:
+
+            CIGAR += '{}D'.format(s - blocks[n-1][1] - 1)
+
+        CIGAR += '{}{}'.format(e-s+1, c)
+
+    seq = []
+
+    phred = []
+
+    overlap = []
+
+    for pos in positions:
+
+        if len(columns[pos]) == 1:
+
+            b, p = single_base_table[columns[pos][0]]
+
+        else:
+
+            b, p = None, None
+
+            overlap.append(len(seq))
+
+        seq.append(b)
+
+        phred.append(p)
+
+    if len(overlap) > 0:
+
+        ll_sums = np.array([[sum([ll_N if b1 == 'N' else ll_this_correct[Q] if b1 == b2 else ll_other_correct[Q] for b1, Q in columns[positions[k]]]) for k in overlap] for b2 in nucleotides])
+
+        overlap_seq, overlap_phred = call_bases(ll_sums)
+
+        for k, b, p in zip(overlap, overlap_seq, overlap_phred):
+
+            seq[k] = b
+
+            phred[k] = p
+
+    v, c = np.unique(reverse_read1, return_counts=True)
+
+    master_read = {}
+
+    master_read['seq'] = ''.join(seq)
+
+    master_read['phred'] = np.array(phred)
+
+    master_read['SN'] = read.reference_name
+
+    master_read['is_reverse'] = v[c.argmax()]
+
+    master_read['NR'] = len(read_d)
+
+    master_read['IR'] = np.sum([read.has_tag('GI') for read in read_d])
+
+    master_read['ER'] = np.sum([read.has_tag('GE') for read in read_d])
+
+    master_read['cell'] = cell
+
+    master_read['gene'] = gene
+
+    master_read['umi'] = umi
+
+    return (True, convert_to_sam(master_read, UMI_tag, (ref_tuples[0][0] + 1, CIGAR)))
+
+
+
 def stitch_reads(read_d, single_end, cell, gene, umi, UMI_tag):
 
+    if len(read_d) <= 2:
+
+        stitched = stitch_single_read(read_d, single_end, cell, gene, umi, UMI_tag)
+
+        if stitched is not None:
+
+            return stitched
+
     master_read = {}
 
     seq_df = None
@@ -190,14 +477,10 @@ def stitch_reads(read_d, single_end, cell, gene, umi, UMI_tag):
 
     intronic_list = [0]*nreads
 
-    seq_list = []
-
-    qual_list = []
+    unique_reads = {}
 
     ref_pos_set = set()
 
-    ref_pos_list = []
-
     for i,read in enumerate(read_d):
 
         if read.has_tag('GE'):
@@ -229,20 +512,45 @@ def stitch_reads(read_d, single_end, cell, gene, umi, UMI_tag):
 
         cigtuples = read.cigartuples
 
-        insertion_locs = get_insertions_locs(cigtuples)
+        # reads with identical alignment and sequence are merged, summing their base likelihoods
 
-        
-        if len(insertion_locs) > 0:
+        key = (read.reference_start, tuple(cigtuples), seq)
 
-            seq = "".join([char for idx, char in enumerate(seq) if idx not in insertion_locs])
+        if key not in unique_reads:
+
+            insertion_locs = get_insertions_locs(cigtuples)
+
+            if len(insertion_locs) > 0:
+
+                seq = "".join([char for idx, char in enumerate(seq) if idx not in insertion_locs])
+
+            ref_positions = read.get_reference_positions()
+
+            skipped_intervals = get_skipped_tuples(cigtuples, ref_positions)
+
+            unique_reads[key] = (seq, insertion_locs, ref_positions, skipped_intervals, [0.0]*len(seq), [0.0]*len(seq))
+
+            ref_pos_set = ref_pos_set | set(ref_positions)
+
+        seq, insertion_locs, ref_positions, skipped_intervals, ll_this, ll_other = unique_reads[key]
+
+        if len(insertion_locs) > 0:
 
             Q_list = [qual for idx, qual in enumerate(Q_list) if idx not in insertion_locs]
 
+        for k, (b1, Q) in enumerate(zip(seq, Q_list)):
 
+            if b1 == 'N':
 
-        ref_positions = read.get_reference_positions()
+                ll_this[k] += ll_N
+
+                ll_other[k] += ll_N
+
+            else:
 
-        skipped_intervals = get_skipped_tuples(cigtuples, ref_positions)
+                ll_this[k] += ll_this_correct[Q]
+
+                ll_other[k] += ll_other_correct[Q]
 
 
         if read.is_read1 and not single_end and read.get_tag(UMI_tag) != '':
@@ -257,17 +565,9 @@ def stitch_reads(read_d, single_end, cell, gene, umi, UMI_tag):
 
         intronic_list[i] = intronic
 
-        seq_list.append(seq)
-
-        qual_list.append(Q_list)
-
-        ref_pos_list.append(ref_positions)
-
-        ref_pos_set = ref_pos_set | set(ref_positions)
-
         if len(master_read) == 0:
 
-            master_read['skipped_intervals'] = skipped_intervals
+            master_read['skipped_intervals'] = list(skipped_intervals)
 
         else:
 
@@ -284,9 +584,9 @@ def stitch_reads(read_d, single_end, cell, gene, umi, UMI_tag):
     ref_to_pos_dict = {p:o for p,o in zip(ref_pos_set_array,using_indexed_assignment(ref_pos_set_array))}
 
 
-    for i, (seq, Q_list, ref_positions) in enumerate(zip(seq_list, qual_list, ref_pos_list)):
+    for i, (seq, insertion_locs, ref_positions, skipped_intervals, ll_this, ll_other) in enumerate(unique_reads.values()):
 
-        for b1, Q, pos in zip(seq,Q_list, ref_positions):
+        for b1, this_ll, other_ll, pos in zip(seq, ll_this, ll_other, ref_positions):
 
             for b2 in nucleotides:
 
@@ -294,17 +594,13 @@ def stitch_reads(read_d, single_end, cell, gene, umi, UMI_tag):
 
                 sparse_col_dict[b2].append(ref_to_pos_dict[pos])
 
-                if b1 == b2:
-
-                    sparse_ll_dict[b2].append(ll_this_correct[Q])
+                if b1 == b2 or b1 == 'N':
 
-                elif b1 == 'N':
-
-                    sparse_ll_dict[b2].append(ll_N)
+                    sparse_ll_dict[b2].append(this_ll)
 
                 else:
 
-                    sparse_ll_dict[b2].append(ll_other_correct[Q])
+                    sparse_ll_dict[b2].append(other_ll)
 
     sparse_csc_dict = {b:csc_matrix((sparse_ll_dict[b], (sparse_row_dict[b],sparse_col_dict[b])), shape=(i+1,len(ref_pos_set_array))) for b in nucleotides}
 
@@ -319,15 +615,9 @@ def stitch_reads(read_d, single_end, cell, gene, umi, UMI_tag):
 
         return (False, ':'.join([gene,cell,umi]))
 
-    full_ll = logsumexp(ll_sums, axis=0)
-
-    prob_max = np.asarray(np.exp(np.amax(ll_sums, axis=0) - full_ll)).ravel()
-
-    nuc_max = np.asarray(np.argmax(ll_sums, axis=0)).ravel()
-
-    master_read['seq'] = ''.join([nucleotides[x] if p > 0.3 else 'N' for p, x in zip(prob_max, nuc_max)])
+    seq, master_read['phred'] = call_bases(ll_sums)
 
-    master_read['phred'] = np.nan_to_num(np.rint(-10*np.log10(1-prob_max+1e-13)))
+    master_read['seq'] = ''.join(seq)
 
     if len(reverse_read1) == 0:
 
@@ -363,7 +653,7 @@ def stitch_reads(read_d, single_end, cell, gene, umi, UMI_tag):
 
 
 
-def get_compatible_isoforms_stitcher(mol_list, isoform_dict_json,refskip_dict_json, h):
+def load_isoform_intervals(isoform_dict_json, refskip_dict_json):
 
     isoform_dict = P.IntervalDict()
 
@@ -377,7 +667,19 @@ def get_compatible_isoforms_stitcher(mol_list, isoform_dict_json,refskip_dict_js
 
         refskip_dict[P.from_string(i, conv=int)] = set(s.split(','))
 
-    
+    return isoform_dict, refskip_dict
+
+
+
+def get_compatible_isoforms_stitcher(mol_list, isoform_dict_json,refskip_dict_json, h):
+
+    isoform_dict, refskip_dict = load_isoform_intervals(isoform_dict_json, refskip_dict_json)
+
+    return assign_compatible_isoforms(mol_list, isoform_dict, refskip_dict, h)
+
+
+
+def assign_compatible_isoforms(mol_list, isoform_dict, refskip_dict, h, intron_chains=None):
 
     compatible_isoforms_trie = dict()
 
@@ -413,6 +715,20 @@ def get_compatible_isoforms_stitcher(mol_list, isoform_dict_json,refskip_dict_js
 
                 j.append((blocks[n][1],blocks[n+1][0]))
 
+        # molecules whose intron chain is annotated and which stay within its flanking exons skip the interval lookup
+
+        if intron_chains is not None and len(j) > 0:
+
+            chain = intron_chains.get(','.join(['{}-{}'.format(s+1, e) for s, e in j]))
+
+            if chain is not None and chain[0] <= blocks[0][0]+1 and blocks[-1][1] <= chain[1] and min([e-s for s, e in blocks]) > 5:
+
+                mol.set_tag('CT', chain[2])
+
+                new_mol_list.append((success,mol.to_string()))
+
+                continue
+
         j = interval(j)
 
         set_list = [s for k,s in isoform_dict.get(i, default={'intronic'}).items() if len(list(P.iterate(k, step=1))) > 4]
@@ -451,15 +767,17 @@ def get_compatible_isoforms_stitcher(mol_list, isoform_dict_json,refskip_dict_js
 
 
 
-def assemble_reads(bamfile,gene_to_stitch, cell_set, isoform_dict_json,refskip_dict_json,single_end,UMI_tag, q):
+def keep_in_preview(key, fraction):
 
-    readtrie = pygtrie.StringTrie()
+    return zlib.crc32(key.encode()) < fraction*4294967296
 
-    bam = pysam.AlignmentFile(bamfile, 'rb')
 
-    gene_of_interest = gene_to_stitch['gene_id']
 
-    for read in bam.fetch(gene_to_stitch['seqid'], gene_to_stitch['start'], gene_to_stitch['end']):
+def group_reads(reads, gene_of_interest, cell_set, single_end, UMI_tag, preview=None):
+
+    readtrie = pygtrie.StringTrie()
+
+    for read in reads:
 
         cell = read.get_tag('BC')
 
@@ -469,8 +787,16 @@ def assemble_reads(bamfile,gene_to_stitch, cell_set, isoform_dict_json,refskip_d
 
                 continue
 
+        if preview is not None and preview[1] == 'cell' and not keep_in_preview(cell, preview[0]):
+
+            continue
+
         umi = read.get_tag(UMI_tag)
 
+        if preview is not None and preview[1] == 'umi' and not keep_in_preview('{}:{}'.format(cell, umi), preview[0]):
+
+            continue
+
         if umi == '':
 
             continue
@@ -553,383 +879,2738 @@ def assemble_reads(bamfile,gene_to_stitch, cell_set, isoform_dict_json,refskip_d
 
                     readtrie[node] = [read]
 
-    mol_list = []
+    return readtrie
 
-    mol_append = mol_list.append
 
-    for node, mol in readtrie.iteritems():
 
-        info = node.split('/')
+class StoredRead:
 
-        n_read1 = np.sum([(r.is_read1)&(r.get_tag(UMI_tag) != '') for r in mol])
+    # the parts of a pysam.AlignedSegment used for stitching, read back from a read store
 
-        if n_read1 > 0:
+    __slots__ = ['reference_name', 'reference_start', 'flag', 'cigartuples', 'query_alignment_sequence', 'query_alignment_qualities', 'cell', 'umi', 'UMI_tag']
 
-            mol_append(stitch_reads(mol, single_end, info[0], info[1], info[2], UMI_tag))
 
-    del readtrie
 
-    if isoform_dict_json is not None:
+    def __init__(self, reference_name, reference_start, flag, cigartuples, seq, qual, cell, umi, UMI_tag):
 
-        mol_list = get_compatible_isoforms_stitcher(mol_list, isoform_dict_json,refskip_dict_json, bam.header)
+        self.reference_name = reference_name
 
-    if len(mol_list) == 0:
+        self.reference_start = reference_start
 
-        return gene_of_interest
+        self.flag = flag
 
-    if len(mol_list) > 50000:
+        self.cigartuples = cigartuples
 
-        for m_list in chunks(mol_list, 50000):
+        self.query_alignment_sequence = seq
 
-            q.put((True, m_list))
+        self.query_alignment_qualities = qual
 
-    else:
+        self.cell = cell
 
-        q.put((True, mol_list))
+        self.umi = umi
 
-    return gene_of_interest
+        self.UMI_tag = UMI_tag
 
 
 
+    @property
 
+    def is_read1(self):
 
-def make_POS_and_CIGAR(stitched_m):
+        return bool(self.flag & 1)
 
-    CIGAR = ''
 
-    conflict = False
 
-    interval_list = []
+    @property
 
-    ref_and_skip_intersect = stitched_m['ref_intervals'] & stitched_m['skipped_intervals']
+    def is_reverse(self):
 
-    nreads_conflict = 0
+        return bool(self.flag & 2)
 
-    if not ref_and_skip_intersect.empty:
 
-        conflict = True
+
+    def has_tag(self, tag):
+
+        return (tag == 'GE' and bool(self.flag & 4)) or (tag == 'GI' and bool(self.flag & 8)) or tag in ('BC', self.UMI_tag)
+
+
+
+    def get_tag(self, tag):
+
+        if tag == 'BC':
+
+            return self.cell
+
+        if tag == self.UMI_tag:
+
+            return self.umi
+
+        raise KeyError("tag '{}' not present".format(tag))
+
+
+
+    def get_reference_positions(self):
+
+        positions = []
+
+        pos = self.reference_start
+
+        for op, l in self.cigartuples:
+
+            if op in (0, 7, 8):
+
+                positions.extend(range(pos, pos+l))
+
+                pos += l
+
+            elif op in (2, 3):
+
+                pos += l
+
+        return positions
+
+
+
+def get_read_store_gene_file(store_dir, gene_id):
+
+    return os.path.join(store_dir, '{}.reads'.format(hashlib.sha1(gene_id.encode()).hexdigest()[:16]))
+
+
+
+def write_read_store_gene(filename, readtrie, gene_to_stitch):
+
+    # one file per gene: the length of a json header, the header with the UMI groups, then one array after the other
+
+    groups = []
+
+    starts, flags, seq_lens, n_cigars, cigars, seqs, quals = [], [], [], [], [], [], []
+
+    for node, reads in readtrie.iteritems():
+
+        cell, gene, umi = node.split('/')
+
+        groups.append([cell, umi, len(reads)])
+
+        for read in reads:
+
+            starts.append(read.reference_start)
+
+            flags.append(read.is_read1 | read.is_reverse << 1 | read.has_tag('GE') << 2 | read.has_tag('GI') << 3)
+
+            seq = read.query_alignment_sequence
+
+            qual = read.query_alignment_qualities
+
+            seq_lens.append(len(seq))
+
+            seqs.append(seq.encode())
+
+            quals.append(bytes(qual) if qual is not None else b'\xff'*len(seq))
+
+            n_cigars.append(len(read.cigartuples))
+
+            cigars.extend([l << 4 | op for op, l in read.cigartuples])
+
+    arrays = [('start', np.array(starts, dtype=np.int64)), ('flag', np.array(flags, dtype=np.uint8)), ('seq_len', np.array(seq_lens, dtype=np.int32)),
+
+              ('n_cigar', np.array(n_cigars, dtype=np.int32)), ('cigar', np.array(cigars, dtype=np.uint32)),
+
+              ('seq', np.frombuffer(b''.join(seqs), dtype=np.uint8)), ('qual', np.frombuffer(b''.join(quals), dtype=np.uint8))]
+
+    offset = 0
+
+    layout = {}
+
+    for name, a in arrays:
+
+        layout[name] = [offset, a.dtype.str, len(a)]
+
+        offset += a.nbytes
+
+    region = [gene_to_stitch['seqid'], gene_to_stitch['start'], gene_to_stitch['end']]
+
+    header = json.dumps({'seqid': gene_to_stitch['seqid'], 'region': region, 'groups': groups, 'arrays': layout}).encode()
+
+    # written under another name first, so a crashed run never leaves a truncated gene behind
+
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+
+    with open(tmp_filename, 'wb') as fp:
+
+        fp.write(len(header).to_bytes(8, 'little'))
+
+        fp.write(header)
+
+        for name, a in arrays:
+
+            fp.write(a.tobytes())
+
+    os.replace(tmp_filename, filename)
+
+
+
+def read_read_store_gene(filename, gene_to_stitch, cell_set, UMI_tag, preview=None):
+
+    # None if the gene is not stored yet, or was stored for another region of the annotation
+
+    if not os.path.exists(filename):
+
+        return None
+
+    mm = np.memmap(filename, dtype=np.uint8, mode='r')
+
+    header_length = int.from_bytes(mm[:8].tobytes(), 'little')
+
+    header = json.loads(mm[8:8+header_length].tobytes())
+
+    if header['region'] != [gene_to_stitch['seqid'], gene_to_stitch['start'], gene_to_stitch['end']]:
+
+        return None
+
+    gene_id = gene_to_stitch['gene_id']
+
+    readtrie = pygtrie.StringTrie()
+
+    a = {name: np.ndarray((length,), dtype=np.dtype(dtype), buffer=mm, offset=8+header_length+offset) for name, (offset, dtype, length) in header['arrays'].items()}
+
+    seq_starts = np.concatenate([[0], np.cumsum(a['seq_len'], dtype=np.int64)])
+
+    cigar_starts = np.concatenate([[0], np.cumsum(a['n_cigar'], dtype=np.int64)])
+
+    seqid = header['seqid']
+
+    i = 0
+
+    for cell, umi, n in header['groups']:
+
+        if not keep_group(cell, umi, cell_set, preview):
+
+            i += n
+
+            continue
+
+        reads = []
+
+        for k in range(i, i+n):
+
+            cigartuples = [(c & 15, c >> 4) for c in a['cigar'][cigar_starts[k]:cigar_starts[k+1]].tolist()]
+
+            seq = a['seq'][seq_starts[k]:seq_starts[k+1]].tobytes()
+
+            reads.append(StoredRead(seqid, int(a['start'][k]), int(a['flag'][k]), cigartuples, seq.decode(), a['qual'][seq_starts[k]:seq_starts[k+1]].tobytes(), cell, umi, UMI_tag))
+
+        readtrie['{}/{}/{}'.format(cell, gene_id, umi)] = reads
+
+        i += n
+
+    return readtrie
+
+
+
+def keep_group(cell, umi, cell_set, preview):
+
+    if cell_set is not None and cell not in cell_set:
+
+        return False
+
+    if preview is not None and not keep_in_preview(cell if preview[1] == 'cell' else '{}:{}'.format(cell, umi), preview[0]):
+
+        return False
+
+    return True
+
+
+
+def filter_readtrie(readtrie, cell_set, preview):
+
+    if cell_set is None and preview is None:
+
+        return readtrie
+
+    filtered = pygtrie.StringTrie()
+
+    for node, reads in readtrie.iteritems():
+
+        cell, gene, umi = node.split('/')
+
+        if keep_group(cell, umi, cell_set, preview):
+
+            filtered[node] = reads
+
+    return filtered
+
+
+
+def fetch_grouped_reads(bam, gene_to_stitch, cell_set, single_end, UMI_tag, preview=None, read_store=None):
+
+    if read_store is None:
+
+        return group_reads(bam.fetch(gene_to_stitch['seqid'], gene_to_stitch['start'], gene_to_stitch['end']), gene_to_stitch['gene_id'], cell_set, single_end, UMI_tag, preview)
+
+    filename = get_read_store_gene_file(read_store, gene_to_stitch['gene_id'])
+
+    readtrie = read_read_store_gene(filename, gene_to_stitch, cell_set, UMI_tag, preview)
+
+    if readtrie is not None:
+
+        return readtrie
+
+    # the store keeps all cells, so later runs can choose other cells or a preview
+
+    readtrie = group_reads(bam.fetch(gene_to_stitch['seqid'], gene_to_stitch['start'], gene_to_stitch['end']), gene_to_stitch['gene_id'], None, single_end, UMI_tag)
+
+    write_read_store_gene(filename, readtrie, gene_to_stitch)
+
+    return filter_readtrie(readtrie, cell_set, preview)
+
+
+
+def open_read_store(store_dir, infile, single_end, UMI_tag, version, shard=None):
+
+    # every shard keeps its own store, so shards sharing a directory do not remove each other's genes
+
+    if shard is not None:
+
+        store_dir = os.path.join(store_dir, 'shard_{}_of_{}'.format(*shard))
+
+    manifest_file = os.path.join(store_dir, 'store.json')
+
+    settings = {'input': os.path.abspath(infile), 'input_mtime': os.path.getmtime(infile), 'input_size': os.path.getsize(infile)}
+
+    # reads are grouped by UMI tag and single-end setting, so every combination has its own subdirectory
+
+    group_dir = os.path.join(store_dir, '{}_{}'.format(UMI_tag, 'single_end' if single_end else 'paired_end'))
+
+    manifest = None
+
+    if os.path.exists(manifest_file):
+
+        with open(manifest_file) as fp:
+
+            manifest = json.load(fp)
+
+    input_changed = manifest is None or not all([manifest.get(k) == v for k, v in settings.items()])
+
+    if input_changed:
+
+        os.makedirs(store_dir, exist_ok=True)
+
+        for f in glob.glob(os.path.join(store_dir, '*', '*.reads')):
+
+            os.remove(f)
+
+        with open(manifest_file, 'w') as fp:
+
+            json.dump(dict(settings, version=version), fp)
+
+    if os.path.isdir(group_dir) and not input_changed:
+
+        # genes that are missing or whose region changed are fetched from the input again
+
+        print('Using read store {}'.format(group_dir))
+
+    else:
+
+        print('Writing grouped reads to new read store {}'.format(group_dir))
+
+        os.makedirs(group_dir, exist_ok=True)
+
+    return group_dir
+
+
+
+def iter_molecules(readtrie, isoform_dict, refskip_dict, single_end, UMI_tag, header, intron_chains=None):
+
+    for node, mol in readtrie.iteritems():
+
+        info = node.split('/')
+
+        n_read1 = np.sum([(r.is_read1)&(r.get_tag(UMI_tag) != '') for r in mol])
+
+        if n_read1 > 0:
+
+            stitched = stitch_reads(mol, single_end, info[0], info[1], info[2], UMI_tag)
+
+            if isoform_dict is None:
+
+                yield stitched
+
+            else:
+
+                for m in assign_compatible_isoforms([stitched], isoform_dict, refskip_dict, header, intron_chains):
+
+                    yield m
+
+
+
+def put_molecules(mol_list, q):
+
+    if len(mol_list) == 0:
+
+        return
+
+    if len(mol_list) > 50000:
+
+        for m_list in chunks(mol_list, 50000):
+
+            q.put((True, m_list))
+
+    else:
+
+        q.put((True, mol_list))
+
+
+
+def assemble_reads(bamfile,gene_to_stitch, cell_set, isoform_dict_json,refskip_dict_json,single_end,UMI_tag, q, bam_threads=0, reference=None, preview=None):
+
+    bam = open_alignment_file(bamfile, 'rb', reference, bam_threads)
+
+    gene_of_interest = gene_to_stitch['gene_id']
+
+    if isoform_dict_json is not None:
+
+        isoform_dict, refskip_dict = load_isoform_intervals(isoform_dict_json, refskip_dict_json)
+
+    else:
+
+        isoform_dict, refskip_dict = None, None
+
+    try:
+
+        readtrie = group_reads(bam.fetch(gene_to_stitch['seqid'], gene_to_stitch['start'], gene_to_stitch['end']), gene_of_interest, cell_set, single_end, UMI_tag, preview)
+
+        mol_list = list(iter_molecules(readtrie, isoform_dict, refskip_dict, single_end, UMI_tag, bam.header))
+
+    finally:
+
+        bam.close()
+
+    del readtrie
+
+    put_molecules(mol_list, q)
+
+    return gene_of_interest
+
+
+
+def count_molecules(mol_list):
+
+    gene_counts = {}
+
+    ec_counts = {}
+
+    for success, m in mol_list:
+
+        if not success:
+
+            continue
+
+        fields = m.split('\t')
+
+        tags = {t[:2]: t[5:] for t in fields[11:]}
+
+        key = (tags['BC'], tags['XT'])
+
+        if key not in gene_counts:
+
+            gene_counts[key] = [0, 0, 0, 0]
+
+        c = gene_counts[key]
+
+        c[0] += 1
+
+        c[1] += int(tags['NR'])
+
+        c[2] += int(tags['ER'])
+
+        c[3] += int(tags['IR'])
+
+        if 'CT' in tags:
+
+            ec = ','.join(sorted(tags['CT'].split(','))) if tags['CT'] != '' else 'none'
+
+            ec_counts[(tags['BC'], ec)] = ec_counts.get((tags['BC'], ec), 0) + 1
+
+    return gene_counts, ec_counts
+
+
+
+def merge_counts(counts_list):
+
+    gene_counts = {}
+
+    ec_counts = {}
+
+    for counts in counts_list:
+
+        if counts is None:
+
+            continue
+
+        for key, c in counts[0].items():
+
+            if key in gene_counts:
+
+                gene_counts[key] = [a + b for a, b in zip(gene_counts[key], c)]
+
+            else:
+
+                gene_counts[key] = c
+
+        for key, n in counts[1].items():
+
+            ec_counts[key] = ec_counts.get(key, 0) + n
+
+    return gene_counts, ec_counts
+
+
+
+def write_count_matrix(filename, rows, cols, values, shape, count_format):
+
+    m = coo_matrix((values, (rows, cols)), shape=shape, dtype=np.int64).tocsr()
+
+    if count_format == 'npz':
+
+        save_npz('{}.npz'.format(filename), m)
+
+    else:
+
+        mmwrite('{}.mtx'.format(filename), m)
+
+
+
+def write_count_matrices(prefix, counts_list, count_format):
+
+    gene_counts, ec_counts = merge_counts(counts_list)
+
+    cells = sorted(set([cell for cell, gene in gene_counts]))
+
+    genes = sorted(set([gene for cell, gene in gene_counts]))
+
+    ecs = sorted(set([ec for cell, ec in ec_counts]))
+
+    cell_index = {c: i for i, c in enumerate(cells)}
+
+    gene_index = {g: i for i, g in enumerate(genes)}
+
+    ec_index = {e: i for i, e in enumerate(ecs)}
+
+    rows = [cell_index[cell] for cell, gene in gene_counts]
+
+    cols = [gene_index[gene] for cell, gene in gene_counts]
+
+    values = np.array(list(gene_counts.values()), dtype=np.int64).reshape(-1, 4)
+
+    for n, name in enumerate(['molecules', 'reads', 'exonic_reads', 'intronic_reads']):
+
+        write_count_matrix('{}_{}'.format(prefix, name), rows, cols, values[:, n], (len(cells), len(genes)), count_format)
+
+    with open('{}_barcodes.tsv'.format(prefix), 'w') as fp:
+
+        fp.write(''.join(['{}\n'.format(c) for c in cells]))
+
+    with open('{}_genes.tsv'.format(prefix), 'w') as fp:
+
+        fp.write(''.join(['{}\n'.format(g) for g in genes]))
+
+    if len(ec_counts) > 0:
+
+        write_count_matrix('{}_ec_molecules'.format(prefix), [cell_index[cell] for cell, ec in ec_counts], [ec_index[ec] for cell, ec in ec_counts],
+
+                           list(ec_counts.values()), (len(cells), len(ecs)), count_format)
+
+        with open('{}_ecs.tsv'.format(prefix), 'w') as fp:
+
+            fp.write(''.join(['{}\n'.format(e) for e in ecs]))
+
+
+
+def get_worker_cached(key, stamp, load):
+
+    # worker processes keep open files and parsed annotation between tasks
+
+    if key not in worker_cache or worker_cache[key][0] != stamp:
+
+        worker_cache[key] = (stamp, load())
+
+    return worker_cache[key][1]
+
+
+
+def get_worker_bam(bamfile, bam_threads, reference=None):
+
+    # a worker keeps only one input file open, a served job on another file closes the previous one
+
+    key = (bamfile, bam_threads, reference, os.path.getmtime(bamfile))
+
+    if 'bam' not in worker_cache or worker_cache['bam'][0] != key:
+
+        if 'bam' in worker_cache:
+
+            worker_cache['bam'][1].close()
+
+        worker_cache['bam'] = (key, open_alignment_file(bamfile, 'rb', reference, bam_threads))
+
+    return worker_cache['bam'][1]
+
+
+
+def get_worker_cell_set(cells):
+
+    if cells is None:
+
+        return None
+
+    return get_worker_cached(('cells', cells), os.path.getmtime(cells), lambda: read_cell_set(cells))
+
+
+
+def load_isoform_files(isoformfile, junctionfile):
+
+    with open(isoformfile) as json_file:
+
+        isoform_unique_intervals = json.load(json_file)
+
+    with open(junctionfile) as json_file:
+
+        refskip_unique_intervals = json.load(json_file)
+
+    return {'isoform': isoform_unique_intervals, 'refskip': refskip_unique_intervals, 'parsed': {}}
+
+
+
+def load_json_file(filename):
+
+    with open(filename) as json_file:
+
+        return json.load(json_file)
+
+
+
+def get_worker_intron_chains(chainfile, gene_id):
+
+    if chainfile is None:
+
+        return None
+
+    intron_chains = get_worker_cached(('chains', chainfile), os.path.getmtime(chainfile), lambda: load_json_file(chainfile))
+
+    return intron_chains.get(gene_id)
+
+
+
+def get_worker_isoform_intervals(isoformfile, junctionfile, gene_id):
+
+    if isoformfile is None:
+
+        return None, None
+
+    annotation = get_worker_cached(('annotation', isoformfile, junctionfile), (os.path.getmtime(isoformfile), os.path.getmtime(junctionfile)),
+
+                                   lambda: load_isoform_files(isoformfile, junctionfile))
+
+    parsed = annotation['parsed']
+
+    if gene_id in parsed:
+
+        parsed[gene_id] = parsed.pop(gene_id)
+
+    else:
+
+        parsed[gene_id] = load_isoform_intervals(annotation['isoform'][gene_id], annotation['refskip'][gene_id])
+
+        if len(parsed) > parsed_annotation_cache_size:
+
+            del parsed[next(iter(parsed))]
+
+    return parsed[gene_id]
+
+
+
+def assemble_reads_cached(bamfile, gene_to_stitch, cells, isoformfile, junctionfile, single_end, UMI_tag, q, bam_threads=0, chainfile=None, count=False, reference=None, preview=None, read_store=None):
+
+    bam = get_worker_bam(bamfile, bam_threads, reference)
+
+    cell_set = get_worker_cell_set(cells)
+
+    gene_of_interest = gene_to_stitch['gene_id']
+
+    isoform_dict, refskip_dict = get_worker_isoform_intervals(isoformfile, junctionfile, gene_of_interest)
+
+    intron_chains = get_worker_intron_chains(chainfile, gene_of_interest)
+
+    readtrie = fetch_grouped_reads(bam, gene_to_stitch, cell_set, single_end, UMI_tag, preview, read_store)
+
+    mol_list = list(iter_molecules(readtrie, isoform_dict, refskip_dict, single_end, UMI_tag, bam.header, intron_chains))
+
+    del readtrie
+
+    put_molecules(mol_list, q)
+
+    return gene_of_interest, count_molecules(mol_list) if count else None
+
+
+
+def assemble_reads_read_ahead(bamfile, genes_to_stitch, cells, isoformfile, junctionfile, single_end, UMI_tag, q, bam_threads=0, chainfile=None, count=False, reference=None, preview=None, read_store=None):
+
+    bam = get_worker_bam(bamfile, bam_threads, reference)
+
+    cell_set = get_worker_cell_set(cells)
+
+    pending = queue.Queue(maxsize=1)
+
+    stop = threading.Event()
+
+    # fetch and group the reads of the next gene while the current one is stitched
+
+    def read_ahead():
+
+        try:
+
+            for gene_to_stitch in genes_to_stitch:
+
+                if stop.is_set():
+
+                    return
+
+                pending.put(fetch_grouped_reads(bam, gene_to_stitch, cell_set, single_end, UMI_tag, preview, read_store))
+
+        except Exception as e:
+
+            pending.put(e)
+
+    gene_counts = []
+
+    reader = threading.Thread(target=read_ahead, daemon=True)
+
+    reader.start()
+
+    try:
+
+        for gene_to_stitch in genes_to_stitch:
+
+            isoform_dict, refskip_dict = get_worker_isoform_intervals(isoformfile, junctionfile, gene_to_stitch['gene_id'])
+
+            intron_chains = get_worker_intron_chains(chainfile, gene_to_stitch['gene_id'])
+
+            readtrie = pending.get()
+
+            if isinstance(readtrie, Exception):
+
+                raise readtrie
+
+            mol_list = list(iter_molecules(readtrie, isoform_dict, refskip_dict, single_end, UMI_tag, bam.header, intron_chains))
+
+            del readtrie
+
+            put_molecules(mol_list, q)
+
+            gene_counts.append((gene_to_stitch['gene_id'], count_molecules(mol_list) if count else None))
+
+    finally:
+
+        # if stitching failed the reader may be blocked on a full queue while iterating over the cached bam file
+
+        stop.set()
+
+        while reader.is_alive():
+
+            try:
+
+                pending.get_nowait()
+
+            except queue.Empty:
+
+                pass
+
+            reader.join(0.1)
+
+    return gene_counts
+
+
+
+def get_decode_threads(n):
+
+    # htslib only starts a decode thread pool for 2 or more threads, a single thread would not be used
+
+    if n == 1:
+
+        warnings.warn('Warning: a single I/O thread per input file starts no decode threads, use at least 2')
+
+        return 0
+
+    return n
+
+
+
+def split_thread_budget(io_threads, threads, read_ahead):
+
+    per_worker = io_threads // threads
+
+    if read_ahead and per_worker < 1:
+
+        warnings.warn('Warning: an I/O thread budget of {} is too small for read-ahead with {} workers, disabling read-ahead'.format(io_threads, threads))
+
+        read_ahead = False
+
+    if read_ahead:
+
+        per_worker -= 1
+
+    return get_decode_threads(per_worker), read_ahead
+
+
+
+def make_POS_and_CIGAR(stitched_m):
+
+    CIGAR = ''
+
+    conflict = False
+
+    interval_list = []
+
+    ref_and_skip_intersect = stitched_m['ref_intervals'] & stitched_m['skipped_intervals']
+
+    nreads_conflict = 0
+
+    if not ref_and_skip_intersect.empty:
+
+        conflict = True
 
         nreads_conflict = len(list(P.iterate(ref_and_skip_intersect, step=1))) 
 
-        stitched_m['skipped_intervals'] = stitched_m['skipped_intervals'] - ref_and_skip_intersect
+        stitched_m['skipped_intervals'] = stitched_m['skipped_intervals'] - ref_and_skip_intersect
+
+        interval_list = [i for t in P.to_data(ref_and_skip_intersect) for i in t[1:-1]]
+
+    ref_tuples = [(i[1] if i[0] else i[1]+1, i[2] if i[3] else i[2]-1) for i in P.to_data(stitched_m['ref_intervals'])]
+
+    if stitched_m['skipped_intervals'].empty:
+
+        skipped_tuples = []
+
+    else:
+
+        skipped_tuples = [(i[1] if i[0] else i[1]+1, i[2] if i[3] else i[2]-1) for i in P.to_data(stitched_m['skipped_intervals'])]
+
+    if stitched_m['del_intervals'].empty:
+
+        del_tuples = []
+
+    else:
+
+        del_tuples = [(i[1] if i[0] else i[1]+1, i[2] if i[3] else i[2]-1) for i in P.to_data(stitched_m['del_intervals'])[1:-1]]
+
+    POS = ref_tuples[0][0] + 1
+
+    tuple_dict = {'M': ref_tuples, 'N': skipped_tuples, 'D': del_tuples}
+
+    while sum(len(t) for t in tuple_dict.values()) > 0:
+
+        pos_dict = {k:v[0][0] for k,v in tuple_dict.items() if len(v) > 0}
+
+        c = min(pos_dict, key=pos_dict.get)
+
+        n_bases = np.int_(tuple_dict[c[0]][0][1]-tuple_dict[c[0]][0][0])+1
+
+        if n_bases == 0:
+
+            del tuple_dict[c[0]][0]
+
+            continue
+
+        CIGAR += '{}{}'.format(n_bases,c[0])
+
+        del tuple_dict[c[0]][0]
+
+    return POS, CIGAR, conflict, nreads_conflict, interval_list
+
+
+
+def convert_to_sam(stitched_m, UMI_tag, pos_and_cigar=None):
+
+    sam_dict = {}
+
+    if pos_and_cigar is None:
+
+        POS, CIGAR, conflict, nreads_conflict, interval_list = make_POS_and_CIGAR(stitched_m)
+
+    else:
+
+        POS, CIGAR = pos_and_cigar
+
+        conflict = False
+
+    sam_dict['QNAME'] = '{}:{}:{}'.format(stitched_m['cell'],stitched_m['gene'],stitched_m['umi'])
+
+    sam_dict['FLAG'] = str(16*stitched_m['is_reverse'])
+
+    sam_dict['RNAME'] = stitched_m['SN']
+
+    sam_dict['POS'] = str(POS)
+
+    sam_dict['MAPQ'] = str(255)
+
+    sam_dict['CIGAR'] = CIGAR
+
+    sam_dict['RNEXT'] = '*'
+
+    sam_dict['PNEXT'] = str(0)
+
+    sam_dict['TLEN'] = str(0)
+
+    sam_dict['SEQ'] = stitched_m['seq']
+
+    sam_dict['QUAL'] = "".join([chr(int(p)) for p in np.clip(stitched_m['phred'],0,126-33)+33])
+
+    sam_dict['NR'] = 'NR:i:{}'.format(stitched_m['NR'])
+
+    sam_dict['ER'] = 'ER:i:{}'.format(stitched_m['ER'])
+
+    sam_dict['IR'] = 'IR:i:{}'.format(stitched_m['IR'])
+
+    sam_dict['BC'] = 'BC:Z:{}'.format(stitched_m['cell'])
+
+    sam_dict['XT'] = 'XT:Z:{}'.format(stitched_m['gene'])
+
+    sam_dict[UMI_tag] = '{}:Z:{}'.format(UMI_tag, stitched_m['umi'])
+
+    #sam_dict['EL'] = 'EL:B:I,{}'.format(','.join([str(e) for e in stitched_m['ends']]))
+
+    if conflict:
+
+        sam_dict['NC'] = 'NC:i:{}'.format(nreads_conflict)
+
+        sam_dict['IL'] = 'IL:B:I,{}'.format(','.join([str(e) for e in interval_list]))
+
+    return '\t'.join(list(sam_dict.values()))
+
+
+
+def yield_reads(read_dict):
+
+    for cell in read_dict:
+
+        for gene in read_dict[cell]:
+
+            #print('\t', gene)
+
+            for umi in read_dict[cell][gene]:
+
+                #print('\t\t', umi)
+
+                yield read_dict[cell][gene][umi], None, cell, gene, umi
+
+
+
+def get_index_runs(filename):
+
+    # the (cell, gene) index stores BGZF offsets, so there is none for CRAM output or a stream
+
+    return None if filename.endswith('.cram') or filename == '-' else []
+
+
+
+def write_indexed(stitcher_bam, reads, index_runs):
+
+    # runs of [cell, gene, virtual offset, number of molecules], the last run grows while the cell and gene stay the same
+
+    if index_runs is None:
+
+        for read in reads:
+
+            stitcher_bam.write(read)
+
+        return
+
+    for read in reads:
+
+        key = (read.get_tag('BC'), read.get_tag('XT'))
+
+        if len(index_runs) > 0 and (index_runs[-1][0], index_runs[-1][1]) == key:
+
+            index_runs[-1][3] += 1
+
+        else:
+
+            index_runs.append([key[0], key[1], stitcher_bam.tell(), 1])
+
+        stitcher_bam.write(read)
+
+
+
+def write_molecule_index(filename, index_runs):
+
+    if index_runs is None:
+
+        return
+
+    with gzip.open('{}.cgi'.format(filename), 'wt') as fp:
+
+        for cell, gene, offset, n in index_runs:
+
+            fp.write('{}\t{}\t{}\t{}\n'.format(cell, gene, offset, n))
+
+
+
+def read_molecule_index(indexfile):
+
+    index = {}
+
+    with gzip.open(indexfile, 'rt') as fp:
+
+        for line in fp:
+
+            cell, gene, offset, n = line.rstrip('\n').split('\t')
+
+            index.setdefault((cell, gene), []).append((int(offset), int(n)))
+
+    return index
+
+
+
+def fetch_molecules(bamfile, cells=None, genes=None, indexfile=None):
+
+    """Yield the molecules of the given cells and/or genes from a stitched .bam file, using its .cgi index."""
+
+    if indexfile is None:
+
+        indexfile = '{}.cgi'.format(bamfile)
+
+    index = read_molecule_index(indexfile)
+
+    cells = set(cells) if cells is not None else None
+
+    genes = set(genes) if genes is not None else None
+
+    runs = sorted([run for (cell, gene), cell_gene_runs in index.items() if (cells is None or cell in cells) and (genes is None or gene in genes) for run in cell_gene_runs])
+
+    bam = pysam.AlignmentFile(bamfile, 'rb', check_sq=False)
+
+    for offset, n in runs:
+
+        bam.seek(offset)
+
+        for i in range(n):
+
+            yield next(bam)
+
+    bam.close()
+
+
+
+def get_error_log_name(filename):
+
+    if filename == '-':
+
+        return 'stitcher_error.log'
+
+    return '{}_error.log'.format(os.path.splitext(filename)[0])
+
+
+
+def create_write_function(filename, bamfile, version, reference=None):
+
+    bam = open_alignment_file(bamfile, 'rb', reference)
+
+    header = bam.header
+
+    
+
+    def write_sam_file(q):
+
+        error_file = open(get_error_log_name(filename), 'w')
+
+        stitcher_bam = open_alignment_file(filename,'wb', reference, header={'HD':header['HD'], 'SQ':header['SQ'], 'PG': [{'ID': 'stitcher.py','VN': '{}'.format(version)}]})
+
+        index_runs = get_index_runs(filename)
+
+        while True:
+
+            good, mol_list = q.get()
+
+            if good is None: break
+
+            if good:
+
+                g = ''
+
+                reads = []
+
+                for success, mol in mol_list:
+
+                    if success:
+
+                        read = pysam.AlignedRead.fromstring(mol,header)
+
+                        if g == '':
+
+                            g = read.get_tag('XT')
+
+                        reads.append(read)
+
+                    else:
+
+                        error_file.write(mol+'\n')
+
+                # molecules of the same cell are written together so they form a single run in the index
+
+                reads.sort(key=lambda r: r.get_tag('BC'))
+
+                write_indexed(stitcher_bam, reads, index_runs)
+
+                if g != '':
+
+                    error_file.write('Gene:{}\n'.format(g))
+
+            q.task_done()
+
+        q.task_done()
+
+        error_file.close()
+
+        stitcher_bam.close()
+
+        write_molecule_index(filename, index_runs)
+
+        return None
+
+    return write_sam_file
+
+
+
+def extract(d, keys):
+
+    return dict((k, d[k]) for k in keys if k in d)
+
+
+
+def parse_shard(shard):
+
+    try:
+
+        k, n_shards = [int(x) for x in shard.split('/')]
+
+    except ValueError:
+
+        raise Exception('Shard must be given as k/N, got {}'.format(shard))
+
+    if n_shards < 1 or k < 1 or k > n_shards:
+
+        raise Exception('Invalid shard {}, k has to be between 1 and N'.format(shard))
+
+    return k, n_shards
+
+
+
+def read_bai_linear_index(indexfile):
+
+    # linear index (smallest virtual offset per 16 kb window) and first/last virtual offset of each reference
+
+    with open(indexfile, 'rb') as fp:
+
+        data = fp.read()
+
+    if data[:4] != b'BAI\1':
+
+        return None
+
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+
+    offset = 8
+
+    linear_index = []
+
+    for r in range(n_ref):
+
+        n_bin = struct.unpack_from('<i', data, offset)[0]
+
+        offset += 4
+
+        span = None
+
+        for b in range(n_bin):
+
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, offset)
+
+            offset += 8
+
+            if bin_id == 37450:
+
+                span = struct.unpack_from('<QQ', data, offset)
+
+            offset += 16*n_chunk
+
+        n_intv = struct.unpack_from('<i', data, offset)[0]
+
+        offset += 4
+
+        linear_index.append((struct.unpack_from('<{}Q'.format(n_intv), data, offset), span))
+
+        offset += 8*n_intv
+
+    return linear_index
+
+
+
+def get_bgzf_ratio(infile, coffset):
+
+    # compressed over uncompressed size of the BGZF block at coffset
+
+    with open(infile, 'rb') as fp:
+
+        fp.seek(coffset)
+
+        head = fp.read(18)
+
+        if len(head) < 18:
+
+            return 0
+
+        bsize = struct.unpack_from('<H', head, 16)[0] + 1
+
+        fp.seek(coffset + bsize - 4)
+
+        isize = struct.unpack('<I', fp.read(4))[0]
+
+    return bsize/isize if isize > 0 else 0
+
+
+
+def get_index_filename(infile):
+
+    for indexfile in [infile + '.bai', os.path.splitext(infile)[0] + '.bai']:
+
+        if os.path.exists(indexfile):
+
+            return indexfile
+
+    return None
+
+
+
+def estimate_gene_reads(infile, gene_dict, reference=None):
+
+    # Reads per contig come from the bam index and are spread over the genes by the compressed bytes between the
+
+    # gene start and end in the .bai linear index. Without a .bai (CRAM, .csi) the genes are weighted by length only,
+    # the second return value tells if the index was used.
+
+    bam = open_alignment_file(infile, 'rb', reference)
+
+    try:
+
+        mapped = {s.contig: s.mapped for s in bam.get_index_statistics()}
+
+    except (AttributeError, ValueError):
+
+        mapped = {contig: length for contig, length in zip(bam.references, bam.lengths)}
+
+    contig_length = dict(zip(bam.references, bam.lengths))
+
+    contig_id = {contig: i for i, contig in enumerate(bam.references)}
+
+    bam.close()
+
+    indexfile = get_index_filename(infile)
+
+    linear_index = read_bai_linear_index(indexfile) if indexfile is not None else None
+
+    if linear_index is not None and len(linear_index) != len(contig_id):
+
+        linear_index = None
+
+    ratio = 0
+
+    if linear_index is not None:
+
+        starts = [span[0] >> 16 for intervals, span in linear_index if span is not None]
+
+        if len(starts) > 0:
+
+            ratio = get_bgzf_ratio(infile, min(starts))
+
+    def get_position(voffset):
+
+        return (voffset >> 16) + (voffset & 0xffff)*ratio
+
+    weights = {}
+
+    for gene_id, g in gene_dict.items():
+
+        seqid = g['seqid']
+
+        length_weight = mapped.get(seqid, 0)*(g['end']-g['start']+1)/contig_length[seqid]
+
+        if linear_index is None or seqid not in contig_id:
+
+            weights[gene_id] = length_weight
+
+            continue
+
+        intervals, span = linear_index[contig_id[seqid]]
+
+        if span is None or len(intervals) == 0 or get_position(span[1]) <= get_position(span[0]):
+
+            weights[gene_id] = length_weight
+
+            continue
+
+        first, last = max(0, g['start']-1) >> 14, g['end'] >> 14
+
+        begin = max(span[0], intervals[first]) if first < len(intervals) else span[1]
+
+        end = min(span[1], intervals[last+1]) if last+1 < len(intervals) else span[1]
+
+        gene_bytes = max(0, get_position(end) - get_position(begin))
+
+        weights[gene_id] = mapped.get(seqid, 0)*gene_bytes/(get_position(span[1]) - get_position(span[0]))
+
+    return weights, linear_index is not None
+
+
+
+def partition_genes(weights, n_shards):
+
+    shards = [[] for i in range(n_shards)]
+
+    heap = [(0.0, i) for i in range(n_shards)]
+
+    for gene_id in sorted(weights, key=lambda g: (-weights[g], g)):
+
+        load, i = heapq.heappop(heap)
+
+        shards[i].append(gene_id)
+
+        heapq.heappush(heap, (load + weights[gene_id] + 1, i))
+
+    return shards
+
+
+
+def get_shard_manifest_name(filename):
+
+    return '{}_shard.json'.format(os.path.splitext(filename)[0])
+
+
+
+def write_shard_manifest(filename, manifest):
+
+    with open(get_shard_manifest_name(filename), 'w') as fp:
+
+        json.dump(manifest, fp)
+
+
+
+def read_shard_manifest(filename):
+
+    manifest_file = get_shard_manifest_name(filename)
+
+    if not os.path.exists(manifest_file):
+
+        raise Exception('No shard manifest {} found for {}'.format(manifest_file, filename))
+
+    with open(manifest_file) as fp:
+
+        return json.load(fp)
+
+
+
+def merge_shards(infiles, outfile, reference=None):
+
+    manifests = sorted([(read_shard_manifest(f), f) for f in infiles], key=lambda t: t[0]['shard'])
+
+    n_shards = set([m['n_shards'] for m, f in manifests])
+
+    if len(n_shards) != 1:
+
+        raise Exception('Shards come from runs with different number of shards: {}'.format(sorted(n_shards)))
+
+    n_shards = n_shards.pop()
+
+    shard_ids = [m['shard'] for m, f in manifests]
+
+    if shard_ids != list(range(1, n_shards+1)):
+
+        raise Exception('Expected each of the shards 1 to {} exactly once, got {}'.format(n_shards, shard_ids))
+
+    if len(set([m['gene_table'] for m, f in manifests])) != 1:
+
+        raise Exception('Shards were created from different gene tables')
+
+    incomplete = [f for m, f in manifests if not m['complete']]
+
+    if len(incomplete) > 0:
+
+        raise Exception('Shards did not finish: {}'.format(', '.join(incomplete)))
+
+    gene_to_shard = {}
+
+    for m, f in manifests:
+
+        for g in m['genes']:
+
+            if g in gene_to_shard:
+
+                raise Exception('Gene {} was stitched in both {} and {}'.format(g, gene_to_shard[g], f))
+
+            gene_to_shard[g] = f
+
+    if len(gene_to_shard) != manifests[0][0]['n_genes_total']:
+
+        raise Exception('Shards cover {} of {} genes'.format(len(gene_to_shard), manifests[0][0]['n_genes_total']))
+
+    prepare_reference(reference, outfile, *infiles)
+
+    header = open_alignment_file(manifests[0][1], 'rb', reference, check_sq=False).header.to_dict()
+
+    merged_bam = open_alignment_file(outfile, 'wb', reference, header=header)
+
+    error_file = open('{}_error.log'.format(os.path.splitext(outfile)[0]), 'w')
+
+    index_runs = get_index_runs(outfile)
+
+    for m, f in manifests:
+
+        bam = open_alignment_file(f, 'rb', reference, check_sq=False)
+
+        for read in bam.fetch(until_eof=True):
+
+            if gene_to_shard.get(read.get_tag('XT')) != f:
+
+                raise Exception('Molecule {} in {} belongs to a gene outside of the shard'.format(read.query_name, f))
+
+            write_indexed(merged_bam, [read], index_runs)
+
+        bam.close()
+
+        shard_error_file = '{}_error.log'.format(os.path.splitext(f)[0])
+
+        if os.path.exists(shard_error_file):
+
+            with open(shard_error_file) as fp:
+
+                for line in fp:
+
+                    error_file.write(line)
+
+    error_file.close()
+
+    merged_bam.close()
+
+    write_molecule_index(outfile, index_runs)
+
+    return len(gene_to_shard)
+
+
+
+def merge_command(argv):
+
+    parser = argparse.ArgumentParser(prog='stitcher.py merge', description='Merge the output of stitcher.py shards into one .bam file')
+
+    parser.add_argument('-o','--output', metavar='output', type=str, help='Output .bam file')
+
+    parser.add_argument('inputs', metavar='input', type=str, nargs='+', help='Output .bam files of all shards')
+
+    parser.add_argument('-r','--reference', metavar='reference', type=str, default=None, help='Reference fasta file, needed for .cram files')
+
+    args = parser.parse_args(argv)
+
+    outfile = args.output
+
+    if outfile is None:
+
+        raise Exception('No output file provided.')
+
+    start = time.time()
+
+    n_genes = merge_shards(args.inputs, outfile, args.reference)
+
+    end = time.time()
+
+    print('Finished merging {} shards covering {} genes to {}, took {}'.format(len(args.inputs), n_genes, outfile, get_time_formatted(end-start)))
+
+
+
+def read_cell_set(cells):
+
+    if cells is not None:
+
+        cell_set = set([line.rstrip() for line in open(cells)])
+
+    else:
+
+        cell_set = None
+
+    return cell_set
+
+
+
+def read_gene_info(gtffile, contig, gene_identifier):
+
+    gene_list = []
+
+    regex_lib = {"gene_id": re.compile(r'(?<=gene_id)\s\"([^;]*)\"'),
+
+                 "gene_name": re.compile(r'(?<=gene_name)\s\"([^;]*)\"')}
+
+    if gene_identifier == 'gene_id':
+
+        n = 1
+
+    elif gene_identifier == 'gene_name':
+
+        n = 5
+
+    else:
+
+        n = 1
+
+    with open(gtffile, 'r') as f:
+
+        for line in f:
+
+            l = line.split('\t')
+
+            if len(l) < 8:
+
+                continue
+
+            if l[2] == 'gene':
+
+                if contig is not None:
+
+                    if l[0] == contig:
+
+                        #TODO: Handle missing 'gene_id' tag represented in this try-except
+
+                        try:
+
+                            gene_list.append({'gene_id': regex_lib[gene_identifier].findall(line)[0], 'seqid': l[0], 'start': int(l[3]),"end": int(l[4])})
+
+                        except:
+
+                            gene_list.append({'gene_id': l[8].split(' ')[1].replace('"', '').strip(';\n'), 'seqid':l[0], 'start':int(l[3]), 'end': int(l[4])})
+
+                    else:
+
+                        continue
+
+                else:
+
+                    try:
+
+                        gene_list.append({'gene_id': regex_lib[gene_identifier].findall(line)[0], 'seqid': l[0], 'start': int(l[3]),"end": int(l[4])})
+
+                    except:
+
+                        gene_list.append({'gene_id': l[8].split(' ')[1].replace('"', '').strip(';\n'), 'seqid':l[0], 'start':int(l[3]), 'end':int(l[4])})
+
+    return gene_list
+
+
+
+def stitch_region(bamfile, gene_to_stitch, cell_set=None, isoform_dict_json=None, refskip_dict_json=None, single_end=False, UMI_tag='UB', intron_chains=None, reference=None, preview=None):
+
+    """Yield the stitched molecules of one gene ({'gene_id', 'seqid', 'start', 'end'}) as pysam.AlignedSegment."""
+
+    if isinstance(bamfile, pysam.AlignmentFile):
+
+        bam = bamfile
+
+    else:
+
+        bam = open_alignment_file(bamfile, 'rb', reference)
+
+    if isoform_dict_json is not None:
+
+        isoform_dict, refskip_dict = load_isoform_intervals(isoform_dict_json, refskip_dict_json)
+
+    else:
+
+        isoform_dict, refskip_dict = None, None
+
+    try:
+
+        readtrie = group_reads(bam.fetch(gene_to_stitch['seqid'], gene_to_stitch['start'], gene_to_stitch['end']), gene_to_stitch['gene_id'], cell_set, single_end, UMI_tag, preview)
+
+        for success, m in iter_molecules(readtrie, isoform_dict, refskip_dict, single_end, UMI_tag, bam.header, intron_chains):
+
+            if success:
+
+                yield pysam.AlignedSegment.fromstring(m, bam.header)
+
+    finally:
+
+        # only close files opened here, not the ones passed in by the caller
+
+        if bam is not bamfile:
+
+            bam.close()
+
+
+
+def stitch_bam(bamfile, gtffile, isoformfile=None, junctionfile=None, cells=None, genes=None, contig=None, single_end=False, UMI_tag='UB', gene_identifier='gene_id', chainfile=None, reference=None, preview=None):
+
+    """Yield the stitched molecules of all genes in the gtf file, one gene at a time, as pysam.AlignedSegment."""
+
+    bam = open_alignment_file(bamfile, 'rb', reference)
+
+    cell_set = set(cells) if cells is not None else None
+
+    gene_dict = {g['gene_id']: g for g in read_gene_info(gtffile, contig, gene_identifier)}
+
+    if genes is not None:
+
+        gene_set = set(genes)
+
+        gene_dict = {k:v for k,v in gene_dict.items() if k in gene_set}
+
+    contig_set = set(bam.references)
+
+    gene_dict = {k:v for k,v in gene_dict.items() if v['seqid'] in contig_set}
+
+    if isoformfile is not None:
+
+        with open(isoformfile) as json_file:
+
+            isoform_unique_intervals = json.load(json_file)
+
+        with open(junctionfile) as json_file:
+
+            refskip_unique_intervals = json.load(json_file)
+
+    if chainfile is not None:
+
+        with open(chainfile) as json_file:
+
+            intron_chains = json.load(json_file)
+
+    try:
+
+        for gene_id, gene_to_stitch in gene_dict.items():
+
+            if isoformfile is not None:
+
+                isoform_dict_json, refskip_dict_json = isoform_unique_intervals[gene_id], refskip_unique_intervals[gene_id]
+
+            else:
+
+                isoform_dict_json, refskip_dict_json = None, None
+
+            gene_intron_chains = intron_chains.get(gene_id) if chainfile is not None else None
+
+            for mol in stitch_region(bam, gene_to_stitch, cell_set, isoform_dict_json, refskip_dict_json, single_end, UMI_tag, gene_intron_chains, preview=preview):
+
+                yield mol
+
+    finally:
+
+        bam.close()
+
+
+
+def clear_compatible_isoforms(m, header):
+
+    mol = pysam.AlignedSegment.fromstring(m, header)
+
+    mol.set_tag('CT', '')
+
+    return mol.to_string()
+
+
+
+def reannotate_gene(bamfile, gene_id, mol_list, isoformfile, junctionfile, chainfile=None, reference=None):
+
+    header = get_worker_bam(bamfile, 0, reference).header
+
+    try:
+
+        isoform_dict, refskip_dict = get_worker_isoform_intervals(isoformfile, junctionfile, gene_id)
+
+    except KeyError:
+
+        # gene is no longer in the annotation, no transcript is compatible
+
+        return gene_id, [clear_compatible_isoforms(m, header) for m in mol_list], False, 0
+
+    intron_chains = get_worker_intron_chains(chainfile, gene_id)
+
+    new_mol_list = []
+
+    n_unassigned = 0
+
+    for m in mol_list:
+
+        assigned = assign_compatible_isoforms([(True, m)], isoform_dict, refskip_dict, header, intron_chains)
+
+        if len(assigned) > 0:
+
+            new_mol_list.append(assigned[0][1])
+
+        else:
+
+            # assign_compatible_isoforms drops molecules it cannot assign, keep them without compatible transcripts
+
+            new_mol_list.append(clear_compatible_isoforms(m, header))
+
+            n_unassigned += 1
+
+    return gene_id, new_mol_list, True, n_unassigned
+
+
+
+def iter_gene_batches(bam, batch_size):
+
+    gene, batch = None, []
+
+    for read in bam.fetch(until_eof=True):
+
+        g = read.get_tag('XT')
+
+        if len(batch) > 0 and (g != gene or len(batch) >= batch_size):
+
+            yield gene, batch
+
+            batch = []
+
+        gene = g
+
+        batch.append(read.to_string())
+
+    if len(batch) > 0:
+
+        yield gene, batch
+
+
+
+def reannotate_molecules(infile, outfile, isoformfile, junctionfile, threads, chainfile=None, reference=None):
+
+    prepare_reference(reference, infile, outfile)
+
+    bam = open_alignment_file(infile, 'rb', reference, check_sq=False)
+
+    header = bam.header
+
+    reannotated_bam = open_alignment_file(outfile, 'wb', reference, header=header.to_dict())
+
+    n_out = 0
+
+    index_runs = get_index_runs(outfile)
+
+    missing_genes = set()
+
+    n_unassigned = 0
+
+    res = Parallel(n_jobs=threads, verbose = 3, backend='loky', return_as='generator')(delayed(reannotate_gene)(infile, gene, mol_list, isoformfile, junctionfile, chainfile, reference) for gene, mol_list in iter_gene_batches(bam, 50000))
+
+    for gene, mol_list, annotated, gene_unassigned in res:
+
+        if not annotated:
+
+            missing_genes.add(gene)
+
+        n_unassigned += gene_unassigned
+
+        write_indexed(reannotated_bam, [pysam.AlignedSegment.fromstring(m, header) for m in mol_list], index_runs)
+
+        n_out += len(mol_list)
+
+    reannotated_bam.close()
+
+    bam.close()
+
+    write_molecule_index(outfile, index_runs)
+
+    if len(missing_genes) > 0:
+
+        warnings.warn('Warning: {} genes not present in {}, their molecules have an empty CT tag'.format(len(missing_genes), isoformfile))
+
+    if n_unassigned > 0:
+
+        warnings.warn('Warning: {} molecules could not be assigned to transcripts, they have an empty CT tag'.format(n_unassigned))
+
+    return n_out
+
+
+
+def reannotate_command(argv):
+
+    parser = argparse.ArgumentParser(prog='stitcher.py reannotate', description='Update the CT tags of a stitched .bam file from new isoform information')
+
+    parser.add_argument('-i','--input',metavar='input', type=str, help='Input .bam file written by stitcher.py')
+
+    parser.add_argument('-o','--output', metavar='output', type=str, help='Output .bam file')
+
+    parser.add_argument('-iso','--isoform',metavar='iso', type=str, help='json file with isoform information')
+
+    parser.add_argument('-jun','--junction', metavar='jun', type=str, help='json file with exon-exon structure')
+
+    parser.add_argument('-ic','--intron-chains', metavar='chains', type=str, default=None, help='json file with intron chains (optional, written by gtf_to_json.py -jc)')
+
+    parser.add_argument('-t', '--threads', metavar='threads', type=int, default=1, help='Number of threads')
+
+    parser.add_argument('-r','--reference', metavar='reference', type=str, default=None, help='Reference fasta file, needed for .cram files')
+
+    args = parser.parse_args(argv)
+
+    infile = args.input
+
+    if infile is None:
+
+        raise Exception('No input file provided.')
+
+    outfile = args.output
+
+    if outfile is None:
+
+        raise Exception('No output file provided.')
+
+    if args.isoform is None or args.junction is None:
+
+        raise Exception('No isoform or junction file provided.')
+
+    start = time.time()
+
+    n_mols = reannotate_molecules(infile, outfile, args.isoform, args.junction, int(args.threads), args.intron_chains, args.reference)
+
+    end = time.time()
+
+    print('Finished writing {} reannotated molecules from {} to {}, took {}'.format(n_mols, infile, outfile, get_time_formatted(end-start)))
+
+
+
+def load_gene_dict(infile, gtffile, gene_file, contig, gene_identifier, reference=None, header=None, gene_list=None):
+
+    if gene_list is None:
+
+        gene_list = read_gene_info(gtffile, contig, gene_identifier)
+
+    elif contig is not None:
+
+        gene_list = [g for g in gene_list if g['seqid'] == contig]
+
+    gene_dict = {g['gene_id']: g for g in gene_list}
+
+    
+
+    if gene_file is not None and gene_file != 'None':
+
+        gene_set = set([line.rstrip() for line in open(gene_file)])
+
+        gene_dict = {k:v for k,v in gene_dict.items() if k in gene_set}
+
+    if header is None:
+
+        bam = open_alignment_file(infile, 'rb', reference)
+
+        header = bam.header
+
+        bam.close()
+
+    contig_set = set([d['SN'] for d in header['SQ']])
+
+    prev_l = len(gene_dict)
+
+    gene_dict = {k:v for k,v in gene_dict.items() if v['seqid'] in contig_set}
+
+    new_l = len(gene_dict)
+
+    diff_l = prev_l - new_l
+
+    print(prev_l, new_l)
+
+    if diff_l > 0:
+
+        warnings.warn('Warning: removed {diff_l} genes with contig not present in bam file'.format(diff_l=diff_l))
+
+    return gene_dict
+
+
+
+def get_size_formatted(n_bytes):
+
+    for unit in ['B', 'KB', 'MB', 'GB']:
+
+        if n_bytes < 1024:
+
+            return '{:.1f} {}'.format(n_bytes, unit)
+
+        n_bytes /= 1024
+
+    return '{:.1f} TB'.format(n_bytes)
+
+
+
+def plan_stitching(infile, gene_dict, cells, isoformfile, junctionfile, single_end, UMI_tag, n_sample, reference=None, preview=None):
+
+    cell_set = read_cell_set(cells)
+
+    gene_ids = sorted(gene_dict)
+
+    if len(gene_ids) == 0:
+
+        raise Exception('No genes to stitch.')
+
+    sample = gene_ids[::max(1, len(gene_ids)//n_sample)][:n_sample]
+
+    weights, weights_from_index = estimate_gene_reads(infile, gene_dict, reference)
+
+    base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+    tracemalloc.start()
+
+    if isoformfile is not None:
+
+        annotation = load_isoform_files(isoformfile, junctionfile)
+
+        annotation_memory = tracemalloc.get_traced_memory()[0]
+
+    else:
+
+        annotation_memory = 0
+
+    bam = open_alignment_file(infile, 'rb', reference)
+
+    sample_file = tempfile.NamedTemporaryFile(suffix='.bam', delete=False)
+
+    sample_file.close()
+
+    sample_bam = pysam.AlignmentFile(sample_file.name, 'wb', header=bam.header.to_dict())
+
+    n_reads, n_groups, n_mols, cpu_time = 0, 0, 0, 0.0
+
+    largest_sampled = (0, 0)
+
+    for gene_id in sample:
+
+        gene_to_stitch = gene_dict[gene_id]
+
+        tracemalloc.reset_peak()
+
+        start = time.process_time()
+
+        readtrie = group_reads(bam.fetch(gene_to_stitch['seqid'], gene_to_stitch['start'], gene_to_stitch['end']), gene_id, cell_set, single_end, UMI_tag, preview)
+
+        if isoformfile is not None:
+
+            isoform_dict, refskip_dict = load_isoform_intervals(annotation['isoform'].get(gene_id, {}), annotation['refskip'].get(gene_id, {}))
+
+        else:
+
+            isoform_dict, refskip_dict = None, None
+
+        mol_list = list(iter_molecules(readtrie, isoform_dict, refskip_dict, single_end, UMI_tag, bam.header))
+
+        cpu_time += time.process_time() - start
+
+        gene_reads = sum([len(mol) for mol in readtrie.values()])
+
+        if gene_reads > largest_sampled[0]:
+
+            largest_sampled = (gene_reads, tracemalloc.get_traced_memory()[1] - annotation_memory)
+
+        n_reads += gene_reads
+
+        n_groups += len(readtrie)
+
+        for success, m in mol_list:
+
+            if success:
+
+                sample_bam.write(pysam.AlignedSegment.fromstring(m, bam.header))
+
+                n_mols += 1
+
+    tracemalloc.stop()
+
+    sample_bam.close()
+
+    bam.close()
+
+    output_size = os.path.getsize(sample_file.name)
+
+    os.remove(sample_file.name)
+
+    sampled_weight = sum([weights[g] for g in sample])
+
+    if weights_from_index and sampled_weight > 0:
+
+        # reads per gene are heavy-tailed, so scale by the estimated reads of the sample rather than its number of genes
+
+        scale = sum(weights.values())/sampled_weight
+
+    else:
+
+        scale = len(gene_ids)/len(sample)
+
+    reads_per_weight = n_reads/sampled_weight if sampled_weight > 0 else 0
+
+    if weights_from_index:
+
+        max_gene_reads = max(largest_sampled[0], max(weights.values())*reads_per_weight)
+
+    else:
+
+        # length says little about the reads of a gene, so allow twice the largest sampled gene
+
+        max_gene_reads = 2*largest_sampled[0]
+
+    bytes_per_read = largest_sampled[1]/largest_sampled[0] if largest_sampled[0] > 0 else 0
+
+    worker_memory = base_memory + annotation_memory + max_gene_reads*bytes_per_read
+
+    total_cpu_time = cpu_time*scale
+
+    try:
+
+        total_memory = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+
+    except (ValueError, OSError):
+
+        total_memory = None
+
+    recommended_threads = min(os.cpu_count() or 1, len(gene_ids))
+
+    if total_memory is not None:
+
+        recommended_threads = min(recommended_threads, int(0.8*total_memory//worker_memory))
+
+    recommended_threads = max(1, recommended_threads)
+
+    print('Plan for stitching {} genes, estimated from {} sampled genes:'.format(len(gene_ids), len(sample)))
+
+    print('  reads:                   {:.0f}'.format(n_reads*scale))
+
+    print('  UMI groups:              {:.0f}'.format(n_groups*scale))
+
+    print('  molecules:               {:.0f}'.format(n_mols*scale))
+
+    print('  reads in largest gene:   {:.0f}'.format(max_gene_reads))
+
+    print('  peak memory per worker:  {}'.format(get_size_formatted(worker_memory)))
+
+    print('  total CPU time:          {}'.format(get_time_formatted(total_cpu_time)))
+
+    print('  output size:             {}'.format(get_size_formatted(output_size*scale)))
+
+    print('  recommended threads:     {}'.format(recommended_threads))
+
+    print('  memory with {} threads:  {}'.format(recommended_threads, get_size_formatted(worker_memory*recommended_threads)))
+
+    print('  wall time with {} threads: {}'.format(recommended_threads, get_time_formatted(total_cpu_time/recommended_threads)))
+
+    return recommended_threads
+
+
+
+def run_profiled_task(profile_dir, func, bamfile, genes_to_stitch, *args):
+
+    if profile_dir is None:
+
+        return func(bamfile, genes_to_stitch, *args)
+
+    # one profiler per worker process, loky workers have no exit hook so its statistics are written every profile_dump_interval seconds
+
+    profile = get_worker_cached(('profiler', profile_dir), None, lambda: {'profiler': cProfile.Profile(), 'memory': [], 'last_dump': time.time()})
+
+    if not tracemalloc.is_tracing():
+
+        tracemalloc.start()
+
+    tracemalloc.reset_peak()
+
+    start = time.time()
+
+    profile['profiler'].enable()
+
+    try:
+
+        return func(bamfile, genes_to_stitch, *args)
+
+    finally:
+
+        profile['profiler'].disable()
+
+        peak = tracemalloc.get_traced_memory()[1]
+
+        genes = genes_to_stitch if type(genes_to_stitch) is list else [genes_to_stitch]
+
+        profile['memory'].append('{}\t{}\t{:.3f}\n'.format(','.join([g['gene_id'] for g in genes]), peak, time.time()-start))
+
+        if time.time() - profile['last_dump'] > profile_dump_interval:
+
+            dump_worker_profile(profile_dir, profile)
+
+
+
+def dump_worker_profile(profile_dir, profile):
+
+    profile['profiler'].dump_stats(os.path.join(profile_dir, 'worker_{}.prof'.format(os.getpid())))
+
+    with open(os.path.join(profile_dir, 'memory_{}.tsv'.format(os.getpid())), 'a') as fp:
+
+        fp.write(''.join(profile['memory']))
+
+    profile['memory'] = []
+
+    profile['last_dump'] = time.time()
+
+
+
+def flush_worker_profile(profile_dir, barrier):
+
+    # every worker waits for the others here, so each of them gets exactly one of these tasks
+
+    try:
+
+        barrier.wait(60)
+
+    except threading.BrokenBarrierError:
+
+        warnings.warn('Warning: not all workers wrote their profile, it may miss the last tasks')
+
+    if ('profiler', profile_dir) in worker_cache:
+
+        dump_worker_profile(profile_dir, worker_cache[('profiler', profile_dir)][1])
+
+
+
+def flush_profiles(profile_dir, threads):
+
+    with Manager() as manager:
+
+        barrier = manager.Barrier(threads)
+
+        Parallel(n_jobs=threads, backend='loky', idle_worker_timeout=worker_idle_timeout)(delayed(flush_worker_profile)(profile_dir, barrier) for i in range(threads))
+
+
+
+def write_profile_summary(profile_dir, n_top):
+
+    profile_files = sorted(glob.glob(os.path.join(profile_dir, 'worker_*.prof')))
+
+    if len(profile_files) == 0:
+
+        warnings.warn('Warning: no worker profiles found in {}'.format(profile_dir))
+
+        return
+
+    stats = pstats.Stats(*profile_files, stream=sys.stdout)
+
+    stats.dump_stats(os.path.join(profile_dir, 'stitcher.prof'))
+
+    print('Merged profiles of {} workers into {}'.format(len(profile_files), os.path.join(profile_dir, 'stitcher.prof')))
+
+    stats.sort_stats('cumulative').print_stats(n_top)
+
+    tasks = []
+
+    for memory_file in glob.glob(os.path.join(profile_dir, 'memory_*.tsv')):
+
+        with open(memory_file) as fp:
+
+            for line in fp:
+
+                genes, peak, seconds = line.rstrip('\n').split('\t')
+
+                tasks.append((int(peak), float(seconds), genes))
+
+    tasks.sort(reverse=True)
+
+    print('Peak traced memory of {} tasks, largest first:'.format(len(tasks)))
+
+    for peak, seconds, genes in tasks[:10]:
+
+        print('  {:>10}  {:>8.2f} s  {}'.format(get_size_formatted(peak), seconds, genes if len(genes) < 60 else genes[:57] + '...'))
+
+
+
+def construct_stitched_molecules(infile, outfile,gtffile,isoformfile, junctionfile, cells, gene_file, contig, threads, single_end, UMI_tag, gene_identifier, skip_iso, q, version, shard=None, io_threads=0, read_ahead=False, chainfile=None, counts_prefix=None, counts_format='mtx', reference=None, preview=None, gene_list=None, profile_dir=None, profile_top=30, read_store_dir=None):
+
+    print('Reading gene info from {}'.format(gtffile))
+
+    gene_dict = load_gene_dict(infile, gtffile, gene_file, contig, gene_identifier, reference, gene_list=gene_list)
+
+    if shard is not None:
+
+        k, n_shards = shard
+
+        n_genes_total = len(gene_dict)
+
+        gene_table = hashlib.sha1(','.join(sorted(gene_dict)).encode()).hexdigest()
+
+        shards = partition_genes(estimate_gene_reads(infile, gene_dict, reference)[0], n_shards)
+
+        gene_dict = {g: gene_dict[g] for g in shards[k-1]}
+
+        print('Shard {}/{}: stitching {} of {} genes'.format(k, n_shards, len(gene_dict), n_genes_total))
+
+        write_shard_manifest(outfile, {'shard': k, 'n_shards': n_shards, 'n_genes_total': n_genes_total, 'gene_table': gene_table,
+
+                                       'genes': sorted(gene_dict), 'version': version, 'complete': False})
+
+    gene_list = list(gene_dict.values())
+
+    #print(gene_df.head())
+
+    bam_threads, read_ahead = split_thread_budget(io_threads, threads, read_ahead)
+
+    if skip_iso:
+
+        print('Skipping isoform info')
+
+        isoformfile, junctionfile, chainfile = None, None, None
+
+    else:    
+
+        print('Reading isoform info from {}'.format(isoformfile))
+
+    read_store = None
+
+    if read_store_dir is not None:
+
+        read_store = open_read_store(read_store_dir, infile, single_end, UMI_tag, version, shard)
+
+    if read_ahead:
+
+        n = max(1, int(np.ceil(len(gene_list)/(threads*8))))
+
+        params = Parallel(n_jobs=threads, verbose = 3, backend='loky', idle_worker_timeout=worker_idle_timeout)(delayed(run_profiled_task)(profile_dir, assemble_reads_read_ahead, infile, genes, cells, isoformfile, junctionfile,
+
+                                                                                                          single_end, UMI_tag, q, bam_threads, chainfile, counts_prefix is not None, reference, preview, read_store) for genes in chunks(gene_list, n))
+
+        params = [p for gene_params in params for p in gene_params]
+
+    else:
+
+        params = Parallel(n_jobs=threads, verbose = 3, backend='loky', idle_worker_timeout=worker_idle_timeout)(delayed(run_profiled_task)(profile_dir, assemble_reads_cached, infile, gene, cells, isoformfile, junctionfile,
+
+                                                                                                      single_end, UMI_tag, q, bam_threads, chainfile, counts_prefix is not None, reference, preview, read_store) for gene in gene_list)
+
+    if counts_prefix is not None:
+
+        print('Writing count matrices to {}_*'.format(counts_prefix))
+
+        write_count_matrices(counts_prefix, [counts for gene, counts in params], counts_format)
+
+    if profile_dir is not None:
+
+        flush_profiles(profile_dir, threads)
+
+        write_profile_summary(profile_dir, profile_top)
+
+    return None
+
+
+
+def iter_streamed_genes(bam, gene_dict, batch_size):
+
+    # reads of a coordinate sorted stream are collected per gene, a gene is complete once the stream has passed its end
+
+    genes_by_contig = {}
+
+    for gene_to_stitch in sorted(gene_dict.values(), key=lambda g: g['start']):
+
+        if gene_to_stitch['seqid'] in genes_by_contig:
+
+            genes_by_contig[gene_to_stitch['seqid']].append(gene_to_stitch)
+
+        else:
+
+            genes_by_contig[gene_to_stitch['seqid']] = [gene_to_stitch]
+
+    contig, contig_genes, next_gene = None, [], 0
+
+    active = []
+
+    batch, n_batch = [], 0
+
+    last_pos = (-1, -1)
+
+    for read in bam.fetch(until_eof=True):
+
+        if read.reference_id < 0:
+
+            break
+
+        if (read.reference_id, read.reference_start) < last_pos:
+
+            raise Exception('Input is not coordinate sorted, {} comes after {}:{}'.format(read.query_name, bam.get_reference_name(last_pos[0]), last_pos[1]))
+
+        last_pos = (read.reference_id, read.reference_start)
+
+        if read.reference_name != contig:
+
+            done, active = active, []
+
+            contig, contig_genes, next_gene = read.reference_name, genes_by_contig.get(read.reference_name, []), 0
+
+        else:
+
+            done = [a for a in active if a[0]['end'] <= read.reference_start]
+
+            if len(done) > 0:
+
+                active = [a for a in active if a[0]['end'] > read.reference_start]
+
+        for gene_to_stitch, reads in done:
+
+            if len(reads) > 0:
+
+                batch.append((gene_to_stitch, reads))
+
+                n_batch += len(reads)
+
+        if n_batch >= batch_size:
+
+            yield batch
+
+            batch, n_batch = [], 0
+
+        # same overlap as bam.fetch(seqid, start, end) on an indexed file
+
+        read_end = read.reference_end if read.reference_end is not None else read.reference_start + 1
+
+        while next_gene < len(contig_genes) and contig_genes[next_gene]['start'] < read_end:
+
+            active.append((contig_genes[next_gene], []))
+
+            next_gene += 1
+
+        read_string = None
+
+        for gene_to_stitch, reads in active:
+
+            if gene_to_stitch['start'] < read_end and read.reference_start < gene_to_stitch['end']:
+
+                if read_string is None:
+
+                    read_string = read.to_string()
+
+                reads.append(read_string)
+
+    for gene_to_stitch, reads in active:
+
+        if len(reads) > 0:
+
+            batch.append((gene_to_stitch, reads))
+
+    if len(batch) > 0:
+
+        yield batch
+
+
+
+def stitch_streamed_genes(header_file, genes, cells, isoformfile, junctionfile, single_end, UMI_tag, chainfile=None, count=False, preview=None):
+
+    header = get_worker_bam(header_file, 0).header
+
+    cell_set = get_worker_cell_set(cells)
+
+    res = []
+
+    for gene_to_stitch, reads in genes:
+
+        gene_of_interest = gene_to_stitch['gene_id']
+
+        isoform_dict, refskip_dict = get_worker_isoform_intervals(isoformfile, junctionfile, gene_of_interest)
+
+        intron_chains = get_worker_intron_chains(chainfile, gene_of_interest)
+
+        readtrie = group_reads((pysam.AlignedSegment.fromstring(r, header) for r in reads), gene_of_interest, cell_set, single_end, UMI_tag, preview)
+
+        mol_list = list(iter_molecules(readtrie, isoform_dict, refskip_dict, single_end, UMI_tag, header, intron_chains))
+
+        del readtrie
+
+        res.append((gene_of_interest, mol_list, count_molecules(mol_list) if count else None))
+
+    return res
+
+
+
+def stream_stitched_molecules(outfile, gtffile, isoformfile, junctionfile, cells, gene_file, contig, threads, single_end, UMI_tag, gene_identifier, skip_iso, version, io_threads=0, chainfile=None, counts_prefix=None, counts_format='mtx', reference=None, preview=None, compression_level=None):
+
+    bam = open_alignment_file('-', 'rb', reference, get_decode_threads(io_threads))
+
+    header = bam.header
+
+    print('Reading gene info from {}'.format(gtffile))
+
+    gene_dict = load_gene_dict('-', gtffile, gene_file, contig, gene_identifier, reference, header)
+
+    if skip_iso:
+
+        print('Skipping isoform info')
+
+        isoformfile, junctionfile, chainfile = None, None, None
+
+    else:
+
+        print('Reading isoform info from {}'.format(isoformfile))
 
-        interval_list = [i for t in P.to_data(ref_and_skip_intersect) for i in t[1:-1]]
+    # the workers only need the header to parse the reads, it is written once to a file they can cache
 
-    ref_tuples = [(i[1] if i[0] else i[1]+1, i[2] if i[3] else i[2]-1) for i in P.to_data(stitched_m['ref_intervals'])]
+    header_file = tempfile.NamedTemporaryFile(suffix='.bam', delete=False)
 
-    if stitched_m['skipped_intervals'].empty:
+    header_file.close()
 
-        skipped_tuples = []
+    pysam.AlignmentFile(header_file.name, 'wb', header=header.to_dict()).close()
 
-    else:
+    if compression_level is None:
 
-        skipped_tuples = [(i[1] if i[0] else i[1]+1, i[2] if i[3] else i[2]-1) for i in P.to_data(stitched_m['skipped_intervals'])]
+        compression_level = 0 if outfile == '-' else 6
 
-    if stitched_m['del_intervals'].empty:
+    if compression_level == 0:
 
-        del_tuples = []
+        mode, format_options = 'wbu', None
 
     else:
 
-        del_tuples = [(i[1] if i[0] else i[1]+1, i[2] if i[3] else i[2]-1) for i in P.to_data(stitched_m['del_intervals'])[1:-1]]
+        mode, format_options = 'wb', ['level={}'.format(compression_level).encode()]
 
-    POS = ref_tuples[0][0] + 1
+    stitcher_bam = open_alignment_file(outfile, mode, reference, header={'HD':header['HD'], 'SQ':header['SQ'], 'PG': [{'ID': 'stitcher.py','VN': '{}'.format(version)}]},
 
-    tuple_dict = {'M': ref_tuples, 'N': skipped_tuples, 'D': del_tuples}
+                                       format_options=format_options)
 
-    while sum(len(t) for t in tuple_dict.values()) > 0:
+    error_file = open(get_error_log_name(outfile), 'w')
 
-        pos_dict = {k:v[0][0] for k,v in tuple_dict.items() if len(v) > 0}
+    index_runs = get_index_runs(outfile)
 
-        c = min(pos_dict, key=pos_dict.get)
+    counts_list = []
 
-        n_bases = np.int_(tuple_dict[c[0]][0][1]-tuple_dict[c[0]][0][0])+1
+    n_mols = 0
 
-        if n_bases == 0:
+    res = Parallel(n_jobs=threads, verbose = 3, backend='loky', return_as='generator')(delayed(stitch_streamed_genes)(header_file.name, genes, cells, isoformfile, junctionfile,
 
-            del tuple_dict[c[0]][0]
+                                                                                                                    single_end, UMI_tag, chainfile, counts_prefix is not None, preview) for genes in iter_streamed_genes(bam, gene_dict, 10000))
 
-            continue
+    for gene_res in res:
 
-        CIGAR += '{}{}'.format(n_bases,c[0])
+        for gene, mol_list, counts in gene_res:
 
-        del tuple_dict[c[0]][0]
+            reads = []
 
-    return POS, CIGAR, conflict, nreads_conflict, interval_list
+            for success, mol in mol_list:
 
+                if success:
 
+                    reads.append(pysam.AlignedSegment.fromstring(mol, header))
 
-def convert_to_sam(stitched_m, UMI_tag):
+                else:
 
-    sam_dict = {}
+                    error_file.write(mol+'\n')
 
-    POS, CIGAR, conflict, nreads_conflict, interval_list = make_POS_and_CIGAR(stitched_m)
+            reads.sort(key=lambda r: r.get_tag('BC'))
 
-    sam_dict['QNAME'] = '{}:{}:{}'.format(stitched_m['cell'],stitched_m['gene'],stitched_m['umi'])
+            write_indexed(stitcher_bam, reads, index_runs)
 
-    sam_dict['FLAG'] = str(16*stitched_m['is_reverse'])
+            if len(reads) > 0:
 
-    sam_dict['RNAME'] = stitched_m['SN']
+                error_file.write('Gene:{}\n'.format(gene))
 
-    sam_dict['POS'] = str(POS)
+            n_mols += len(reads)
 
-    sam_dict['MAPQ'] = str(255)
+            counts_list.append(counts)
 
-    sam_dict['CIGAR'] = CIGAR
+    stitcher_bam.close()
 
-    sam_dict['RNEXT'] = '*'
+    error_file.close()
 
-    sam_dict['PNEXT'] = str(0)
+    bam.close()
 
-    sam_dict['TLEN'] = str(0)
+    os.remove(header_file.name)
 
-    sam_dict['SEQ'] = stitched_m['seq']
+    write_molecule_index(outfile, index_runs)
 
-    sam_dict['QUAL'] = "".join([chr(int(p)) for p in np.clip(stitched_m['phred'],0,126-33)+33])
+    if counts_prefix is not None:
 
-    sam_dict['NR'] = 'NR:i:{}'.format(stitched_m['NR'])
+        print('Writing count matrices to {}_*'.format(counts_prefix))
 
-    sam_dict['ER'] = 'ER:i:{}'.format(stitched_m['ER'])
+        write_count_matrices(counts_prefix, counts_list, counts_format)
 
-    sam_dict['IR'] = 'IR:i:{}'.format(stitched_m['IR'])
+    return n_mols
 
-    sam_dict['BC'] = 'BC:Z:{}'.format(stitched_m['cell'])
 
-    sam_dict['XT'] = 'XT:Z:{}'.format(stitched_m['gene'])
 
-    sam_dict[UMI_tag] = '{}:Z:{}'.format(UMI_tag, stitched_m['umi'])
+def run_served_job(job, gene_list, m, gtffile, isoformfile, junctionfile, chainfile, threads, single_end, UMI_tag, gene_identifier, skip_iso, io_threads=0, read_ahead=False, reference=None):
 
-    #sam_dict['EL'] = 'EL:B:I,{}'.format(','.join([str(e) for e in stitched_m['ends']]))
+    infile = job['input']
 
-    if conflict:
+    outfile = job['output']
 
-        sam_dict['NC'] = 'NC:i:{}'.format(nreads_conflict)
+    prepare_reference(reference, infile, outfile)
 
-        sam_dict['IL'] = 'IL:B:I,{}'.format(','.join([str(e) for e in interval_list]))
+    q = m.JoinableQueue()
 
-    return '\t'.join(list(sam_dict.values()))
+    p = Process(target=create_write_function(filename=outfile, bamfile=infile, version=__version__, reference=reference), args=(q,))
 
+    p.start()
 
+    start = time.time()
 
-def yield_reads(read_dict):
+    try:
 
-    for cell in read_dict:
+        construct_stitched_molecules(infile, outfile, gtffile, isoformfile, junctionfile, job.get('cells'), job.get('genes'), job.get('contig'), threads, single_end, UMI_tag, gene_identifier, skip_iso, q, __version__,
 
-        for gene in read_dict[cell]:
+                                     io_threads=io_threads, read_ahead=read_ahead, chainfile=chainfile, counts_prefix=job.get('counts'), reference=reference, gene_list=gene_list)
 
-            #print('\t', gene)
+    finally:
 
-            for umi in read_dict[cell][gene]:
+        q.put((None,None))
 
-                #print('\t\t', umi)
+        p.join()
 
-                yield read_dict[cell][gene][umi], None, cell, gene, umi
+    end = time.time()
 
+    return 'Finished writing stitched molecules from {} to {}, took {}'.format(infile, outfile, get_time_formatted(end-start))
 
 
 
+def serve_jobs(socket_path, gtffile, isoformfile, junctionfile, chainfile, threads, single_end, UMI_tag, gene_identifier, skip_iso, io_threads=0, read_ahead=False, reference=None):
 
-def create_write_function(filename, bamfile, version):
+    global worker_idle_timeout
 
-    bam = pysam.AlignmentFile(bamfile, 'rb')
+    if os.path.exists(socket_path):
 
-    header = bam.header
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
 
-    
+            raise Exception('{} exists and is not a socket.'.format(socket_path))
 
-    def write_sam_file(q):
+        try:
 
-        error_file = open('{}_error.log'.format(os.path.splitext(filename)[0]), 'w')
+            submit_job(socket_path, {'ping': True})
 
-        stitcher_bam = pysam.AlignmentFile(filename,'wb',header={'HD':header['HD'], 'SQ':header['SQ'], 'PG': [{'ID': 'stitcher.py','VN': '{}'.format(version)}]})
+        except (ConnectionRefusedError, ValueError):
+
+            # left over from a server that did not shut down
+
+            os.remove(socket_path)
+
+        else:
+
+            raise Exception('A server is already listening on {}.'.format(socket_path))
+
+    print('Reading gene info from {}'.format(gtffile))
+
+    gene_list = read_gene_info(gtffile, None, gene_identifier)
+
+    # workers keep the parsed annotation between jobs
+
+    worker_idle_timeout = 24*3600
+
+    m = Manager()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    server.bind(socket_path)
+
+    server.listen()
+
+    print('Listening for jobs on {}'.format(socket_path))
+
+    try:
 
         while True:
 
-            good, mol_list = q.get()
+            conn, _ = server.accept()
 
-            if good is None: break
+            with conn:
 
-            if good:
+                try:
 
-                g = ''
+                    job = json.loads(conn.makefile('r').readline())
 
-                for success, mol in mol_list:
+                except ValueError:
 
-                    if success:
+                    continue
 
-                        read = pysam.AlignedRead.fromstring(mol,header)
+                if job.get('ping'):
 
-                        if g == '':
+                    conn.sendall((json.dumps({'success': True, 'message': 'Server on {} is running'.format(socket_path)})+'\n').encode())
 
-                            g = read.get_tag('XT')
+                    continue
 
-                        stitcher_bam.write(read)
+                if job.get('stop'):
 
-                    else:
+                    conn.sendall((json.dumps({'success': True, 'message': 'Stopped server on {}'.format(socket_path)})+'\n').encode())
 
-                        error_file.write(mol+'\n')
+                    break
 
-                if g != '':
+                print('Running job: {}'.format(json.dumps(job)))
 
-                    error_file.write('Gene:{}\n'.format(g))
+                try:
 
-            q.task_done()
+                    reply = {'success': True, 'message': run_served_job(job, gene_list, m, gtffile, isoformfile, junctionfile, chainfile, threads, single_end, UMI_tag, gene_identifier, skip_iso, io_threads, read_ahead, reference)}
 
-        q.task_done()
+                except Exception as e:
 
-        error_file.close()
+                    reply = {'success': False, 'message': '{}: {}'.format(type(e).__name__, e)}
 
-        stitcher_bam.close()
+                print(reply['message'])
 
-        return None
+                try:
 
-    return write_sam_file
+                    conn.sendall((json.dumps(reply)+'\n').encode())
 
+                except OSError:
 
+                    warnings.warn('Warning: client disconnected before the job finished')
 
-def extract(d, keys):
+    finally:
 
-    return dict((k, d[k]) for k in keys if k in d)
+        server.close()
 
-    
+        os.remove(socket_path)
 
-def construct_stitched_molecules(infile, outfile,gtffile,isoformfile, junctionfile, cells, gene_file, contig, threads, single_end, UMI_tag, gene_identifier, skip_iso, q, version):
+        m.shutdown()
 
-    if cells is not None:
 
-        cell_set = set([line.rstrip() for line in open(cells)])
 
-    else:
+def submit_job(socket_path, job):
 
-        cell_set = None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
-    print('Reading gene info from {}'.format(gtffile))
+    client.connect(socket_path)
 
-    gene_list = []
+    client.sendall((json.dumps(job)+'\n').encode())
 
-    regex_lib = {"gene_id": re.compile(r'(?<=gene_id)\s\"([^;]*)\"'),
+    reply = json.loads(client.makefile('r').readline())
 
-                 "gene_name": re.compile(r'(?<=gene_name)\s\"([^;]*)\"')}
+    client.close()
 
-    if gene_identifier == 'gene_id':
+    return reply
 
-        n = 1
 
-    elif gene_identifier == 'gene_name':
 
-        n = 5
+def serve_command(argv):
 
-    else:
+    parser = argparse.ArgumentParser(prog='stitcher.py serve', description='Keep the annotation and workers loaded and stitch jobs sent to a Unix socket with "stitcher.py submit"')
 
-        n = 1
+    parser.add_argument('-s','--socket', metavar='socket', type=str, help='Path of the Unix socket to listen on')
 
-    with open(gtffile, 'r') as f:
+    parser.add_argument('-g','--gtf', metavar='gtf', type=str, help='gtf file with gene information')
 
-        for line in f:
+    parser.add_argument('-iso','--isoform',metavar='iso', type=str, help='json file with isoform information')
 
-            l = line.split('\t')
+    parser.add_argument('-jun','--junction', metavar='jun', type=str, help='json file with exon-exon structure')
 
-            if len(l) < 8:
+    parser.add_argument('-ic','--intron-chains', metavar='chains', type=str, default=None, help='json file with intron chains (optional, written by gtf_to_json.py -jc)')
 
-                continue
+    parser.add_argument('-t', '--threads', metavar='threads', type=int, default=1, help='Number of threads')
 
-            if l[2] == 'gene':
+    parser.add_argument('-r','--reference', metavar='reference', type=str, default=None, help='Reference fasta file, needed for .cram input or output')
 
-                if contig is not None:
+    parser.add_argument('--io-threads', metavar='io_threads', type=int, default=0, help='Total number of extra threads for reading the input .bam file, shared by the workers. Each worker gets io_threads // threads of them (one less with --read-ahead) and decodes in parallel if that leaves 2 or more')
 
-                    if l[0] == contig:
+    parser.add_argument('--read-ahead', action='store_true', help='Fetch the reads of the next gene while the current one is stitched (uses one thread of --io-threads per worker, so needs --io-threads of at least --threads)')
 
-                        #TODO: Handle missing 'gene_id' tag represented in this try-except
+    parser.add_argument('--single-end', action='store_true', help='Activate flag if data is single-end')
 
-                        try:
+    parser.add_argument('--skip-iso', action='store_true', help='Skip isoform calling')
 
-                            gene_list.append({'gene_id': regex_lib[gene_identifier].findall(line)[0], 'seqid': l[0], 'start': int(l[3]),"end": int(l[4])})
+    parser.add_argument('--UMI-tag', type=str, default='UB', help='UMI tag to group reads')
 
-                        except:
+    parser.add_argument('--gene-identifier', default='gene_id', metavar='gene_identifier', type=str, help='Gene identifier (gene_id or gene_name)')
 
-                            gene_list.append({'gene_id': l[8].split(' ')[1].replace('"', '').strip(';\n'), 'seqid':l[0], 'start':int(l[3]), 'end': int(l[4])})
+    args = parser.parse_args(argv)
 
-                    else:
+    if args.socket is None:
 
-                        continue
+        raise Exception('No socket provided.')
 
-                else:
+    if args.gtf is None:
 
-                    try:
+        raise Exception('No gtf file provided.')
 
-                        gene_list.append({'gene_id': regex_lib[gene_identifier].findall(line)[0], 'seqid': l[0], 'start': int(l[3]),"end": int(l[4])})
+    if not args.skip_iso and (args.isoform is None or args.junction is None):
 
-                    except:
+        raise Exception('No isoform or junction file provided.')
 
-                        gene_list.append({'gene_id': l[8].split(' ')[1].replace('"', '').strip(';\n'), 'seqid':l[0], 'start':int(l[3]), 'end':int(l[4])})
+    # the workers check the files by path, so they have to be absolute like the paths sent by the clients
 
-    gene_dict = {g['gene_id']: g for g in gene_list}
+    isoformfile = os.path.abspath(args.isoform) if args.isoform is not None else None
 
-    
+    junctionfile = os.path.abspath(args.junction) if args.junction is not None else None
 
-    if gene_file is not None and gene_file != 'None':
+    chainfile = os.path.abspath(args.intron_chains) if args.intron_chains is not None else None
 
-        gene_set = set([line.rstrip() for line in open(gene_file)])
+    reference = os.path.abspath(args.reference) if args.reference is not None else None
 
-        gene_dict = {k:v for k,v in gene_dict.items() if k in gene_set}
+    serve_jobs(args.socket, args.gtf, isoformfile, junctionfile, chainfile, int(args.threads), args.single_end, args.UMI_tag, args.gene_identifier, args.skip_iso,
 
-    bam = pysam.AlignmentFile(infile, 'rb')
+               args.io_threads, args.read_ahead, reference)
 
-    contig_set = set([d['SN'] for d in bam.header['SQ']])
 
-    prev_l = len(gene_dict)
 
-    gene_dict = {k:v for k,v in gene_dict.items() if v['seqid'] in contig_set}
+def submit_command(argv):
 
-    new_l = len(gene_dict)
+    parser = argparse.ArgumentParser(prog='stitcher.py submit', description='Send a stitching job to a running "stitcher.py serve"')
 
-    diff_l = prev_l - new_l
+    parser.add_argument('-s','--socket', metavar='socket', type=str, help='Unix socket of the server')
 
-    print(prev_l, new_l)
+    parser.add_argument('-i','--input',metavar='input', type=str, help='Input .bam file')
 
-    if diff_l > 0:
+    parser.add_argument('-o','--output', metavar='output', type=str, help='Output .bam file')
 
-        warnings.warn('Warning: removed {diff_l} genes with contig not present in bam file'.format(diff_l=diff_l))
+    parser.add_argument('--cells', default=None, metavar='cells', type=str, help='List of cell barcodes to stitch molecules')
 
-    bam.close()
+    parser.add_argument('--genes', default=None, metavar='genes', type=str, help='List of gene,  one per line.')
 
-    #print(gene_df.head())
+    parser.add_argument('--contig', default=None, metavar='contig', type=str, help='Restrict stitching to contig')
 
-    if skip_iso:
+    parser.add_argument('--counts', default=None, metavar='counts', type=str, help='Prefix for cell x gene and cell x equivalence class count matrices written during stitching')
 
-        print('Skipping isoform info')
+    parser.add_argument('--stop', action='store_true', help='Shut down the server')
 
-        params = Parallel(n_jobs=threads, verbose = 3, backend='loky')(delayed(assemble_reads)(infile, gene, cell_set,None, None, single_end, UMI_tag, q) for index, gene in zip(range(len(gene_list)),gene_list))
+    args = parser.parse_args(argv)
 
-    else:    
+    if args.socket is None:
 
-        print('Reading isoform info from {}'.format(isoformfile))
+        raise Exception('No socket provided.')
 
-        with open(isoformfile) as json_file:
+    if args.stop:
 
-            isoform_unique_intervals = json.load(json_file)
+        job = {'stop': True}
 
-        with open(junctionfile) as json_file:
+    else:
 
-            refskip_unique_intervals = json.load(json_file)
+        if args.input is None:
 
-        params = Parallel(n_jobs=threads, verbose = 3, backend='loky')(delayed(assemble_reads)(infile, gene, cell_set,
+            raise Exception('No input file provided.')
 
-                                                                                               isoform_unique_intervals[gene_list[index]["gene_id"]],
+        if args.output is None:
 
-                                                                                               refskip_unique_intervals[gene_list[index]["gene_id"]],
+            raise Exception('No output file provided.')
 
-                                                                                               single_end, UMI_tag, q) for index, gene in zip(range(len(gene_list)),gene_list))
+        # the server runs in its own working directory
 
+        job = {'input': os.path.abspath(args.input), 'output': os.path.abspath(args.output), 'contig': args.contig}
 
+        for key, filename in [('cells', args.cells), ('genes', args.genes), ('counts', args.counts)]:
 
+            job[key] = os.path.abspath(filename) if filename is not None else None
 
+    reply = submit_job(args.socket, job)
 
-    return None
+    if not reply['success']:
 
+        raise Exception(reply['message'])
 
+    print(reply['message'])
 
-if __name__ == '__main__':
+
+
+def main():
+
+    subcommands = {'merge': merge_command, 'reannotate': reannotate_command, 'serve': serve_command, 'submit': submit_command}
+
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+
+        subcommands[sys.argv[1]](sys.argv[2:])
+
+        sys.exit(0)
 
     parser = argparse.ArgumentParser(description='Stitch together molecules from reads sharing the same UMI')
 
@@ -943,8 +3624,18 @@ if __name__ == '__main__':
 
     parser.add_argument('-jun','--junction', metavar='jun', type=str, help='json file with exon-exon structure')
 
+    parser.add_argument('-ic','--intron-chains', metavar='chains', type=str, default=None, help='json file with intron chains (optional, written by gtf_to_json.py -jc)')
+
     parser.add_argument('-t', '--threads', metavar='threads', type=int, default=1, help='Number of threads')
 
+    parser.add_argument('-r','--reference', metavar='reference', type=str, default=None, help='Reference fasta file, needed for .cram input or output')
+
+    parser.add_argument('--compression-level', metavar='compression_level', type=int, default=None, help='Compression level of the output .bam file when reading from stdin (0 for uncompressed, default 0 when writing to stdout)')
+
+    parser.add_argument('--io-threads', metavar='io_threads', type=int, default=0, help='Total number of extra threads for reading the input .bam file, shared by the workers. Each worker gets io_threads // threads of them (one less with --read-ahead) and decodes in parallel if that leaves 2 or more')
+
+    parser.add_argument('--read-ahead', action='store_true', help='Fetch the reads of the next gene while the current one is stitched (uses one thread of --io-threads per worker, so needs --io-threads of at least --threads)')
+
     parser.add_argument('--single-end', action='store_true', help='Activate flag if data is single-end')
 
     parser.add_argument('--skip-iso', action='store_true', help='Skip isoform calling')
@@ -957,6 +3648,26 @@ if __name__ == '__main__':
 
     parser.add_argument('--contig', default=None, metavar='contig', type=str, help='Restrict stitching to contig')
 
+    parser.add_argument('--preview', default=None, metavar='fraction', type=float, help='Only stitch a deterministic fraction of the molecules (whole UMI groups, or whole cells with --preview-by cell)')
+
+    parser.add_argument('--preview-by', default='umi', choices=['umi', 'cell'], help='Keep or drop whole UMI groups or whole cells in --preview')
+
+    parser.add_argument('--counts', default=None, metavar='counts', type=str, help='Prefix for cell x gene and cell x equivalence class count matrices written during stitching')
+
+    parser.add_argument('--counts-format', default='mtx', choices=['mtx', 'npz'], help='Format of the count matrices (Matrix Market or scipy .npz)')
+
+    parser.add_argument('--profile', default=None, metavar='profile', type=str, help='Directory for cProfile statistics and memory peaks of every worker task, merged into profile/stitcher.prof at the end of the run (not available with -i -)')
+
+    parser.add_argument('--profile-top', metavar='profile_top', type=int, default=30, help='Number of functions in the profile summary printed with --profile')
+
+    parser.add_argument('--read-store', default=None, metavar='read_store', type=str, help='Directory with the grouped reads of every gene, written on the first run and read instead of the input .bam file on later runs (not available with --plan or stdin input)')
+
+    parser.add_argument('--plan', action='store_true', help='Only estimate runtime, memory and output size from a sample of the genes, without stitching')
+
+    parser.add_argument('--plan-genes', metavar='plan_genes', type=int, default=200, help='Number of genes sampled for --plan')
+
+    parser.add_argument('--shard', default=None, metavar='shard', type=str, help='Only stitch shard k of N (given as k/N), merge the shards with "stitcher.py merge"')
+
     parser.add_argument('--gene-identifier', default='gene_id', metavar='gene_identifier', type=str, help='Gene identifier (gene_id or gene_name)')
 
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
@@ -971,10 +3682,16 @@ if __name__ == '__main__':
 
     outfile = args.output
 
-    if outfile is None:
+    if outfile is None and not args.plan:
 
         raise Exception('No output file provided.')
 
+    if outfile == '-':
+
+        # stdout carries the .bam file, messages go to stderr
+
+        sys.stdout = sys.stderr
+
     gtffile = args.gtf  
 
     if gtffile is None:
@@ -989,12 +3706,16 @@ if __name__ == '__main__':
 
         junctionfile = args.junction
 
+        chainfile = args.intron_chains
+
     else:
 
         isoformfile = ''
 
         junctionfile = ''
 
+        chainfile = None
+
     threads = int(args.threads)
 
     cells = args.cells
@@ -1009,11 +3730,87 @@ if __name__ == '__main__':
 
     gene_identifier = args.gene_identifier
 
+    io_threads = args.io_threads
+
+    read_ahead = args.read_ahead
+
+    reference = args.reference
+
+    prepare_reference(reference, infile, outfile if outfile is not None else '')
+
+    preview = args.preview
+
+    if preview is not None:
+
+        if not 0 < preview <= 1:
+
+            raise Exception('Preview fraction has to be between 0 and 1, got {}'.format(preview))
+
+        preview = (preview, args.preview_by)
+
+    shard = args.shard
+
+    if shard is not None:
+
+        shard = parse_shard(shard)
+
+    profile_dir = args.profile
+
+    if profile_dir is not None and infile == '-':
+
+        raise Exception('--profile needs an indexed input file, not a stream from stdin.')
+
+    if profile_dir is not None:
+
+        profile_dir = os.path.abspath(profile_dir)
+
+        os.makedirs(profile_dir, exist_ok=True)
+
+        # statistics of an earlier run in the same directory would be merged in
+
+        for f in glob.glob(os.path.join(profile_dir, 'worker_*.prof')) + glob.glob(os.path.join(profile_dir, 'memory_*.tsv')):
+
+            os.remove(f)
+
+    if args.read_store is not None and (infile == '-' or args.plan):
+
+        raise Exception('--read-store needs an indexed input file and is not used by --plan.')
+
+    if infile == '-':
+
+        if shard is not None or args.plan or read_ahead:
+
+            raise Exception('--shard, --plan and --read-ahead need an indexed input file, not a stream from stdin.')
+
+        print('Stitching reads from stdin')
+
+        start = time.time()
+
+        n_mols = stream_stitched_molecules(outfile, gtffile, isoformfile, junctionfile, cells, gene_file, contig, threads, single_end, UMI_tag, gene_identifier, skip_iso, __version__,
+
+                                           io_threads, chainfile, args.counts, args.counts_format, reference, preview, args.compression_level)
+
+        end = time.time()
+
+        print('Finished writing {} stitched molecules from stdin to {}, took {}'.format(n_mols, outfile, get_time_formatted(end-start)))
+
+        sys.exit(0)
+
+    if args.plan:
+
+        print('Reading gene info from {}'.format(gtffile))
+
+        gene_dict = load_gene_dict(infile, gtffile, gene_file, contig, gene_identifier, reference)
+
+        plan_stitching(infile, gene_dict, cells, None if skip_iso else isoformfile, None if skip_iso else junctionfile, single_end, UMI_tag, args.plan_genes, reference, preview)
+
+        sys.exit(0)
+
     m = Manager()
 
     q = m.JoinableQueue()
 
-    p = Process(target=create_write_function(filename=outfile, bamfile=infile, version=__version__), args=(q,))
+    p = Process(target=create_write_function(filename=outfile, bamfile=infile, version=__version__, reference=reference), args=(q,))
 
     p.start()
 
@@ -1023,14 +3820,35 @@ if __name__ == '__main__':
 
     start = time.time()
 
-    construct_stitched_molecules(infile, outfile, gtffile, isoformfile,junctionfile, cells, gene_file, contig, threads,single_end,UMI_tag,gene_identifier, skip_iso, q, __version__)
+    construct_stitched_molecules(infile, outfile, gtffile, isoformfile,junctionfile, cells, gene_file, contig, threads,single_end,UMI_tag,gene_identifier, skip_iso, q, __version__, shard, io_threads, read_ahead, chainfile, args.counts, args.counts_format, reference, preview,
+
+                                 profile_dir=profile_dir, profile_top=args.profile_top, read_store_dir=args.read_store)
 
     q.put((None,None))
 
     p.join()
 
+    if shard is not None:
+
+        manifest = read_shard_manifest(outfile)
+
+        manifest['complete'] = True
+
+        write_shard_manifest(outfile, manifest)
+
     end = time.time()
 
     
 
     print('Finished writing stitched molecules from {} to {}, took {}'.format(infile, outfile, get_time_formatted(end-start)))
+
+
+
+if __name__ == '__main__':
+
+    # loky pickles the functions of a script run as __main__ by value, with new globals for every batch of tasks, so the
+    # worker caches would not last between tasks. Running from the imported module pickles them by reference instead.
+
+    import stitcher
+
+    stitcher.main()
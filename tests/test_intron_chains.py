@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import subprocess
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import stitcher
+
+# the exons of T2a and T2b are deliberately not in coordinate order
+GTF = [
+    ('gene', 1001, 2300, '+', 'G1', None),
+    ('transcript', 1001, 2300, '+', 'G1', 'T1a'),
+    ('exon', 1001, 1200, '+', 'G1', 'T1a'),
+    ('exon', 1501, 1700, '+', 'G1', 'T1a'),
+    ('exon', 2001, 2300, '+', 'G1', 'T1a'),
+    ('transcript', 1001, 2300, '+', 'G1', 'T1b'),
+    ('exon', 1001, 1200, '+', 'G1', 'T1b'),
+    ('exon', 2001, 2300, '+', 'G1', 'T1b'),
+    ('gene', 5001, 6800, '-', 'G2', None),
+    ('transcript', 5001, 6800, '-', 'G2', 'T2a'),
+    ('exon', 5001, 5300, '-', 'G2', 'T2a'),
+    ('exon', 6501, 6800, '-', 'G2', 'T2a'),
+    ('exon', 5801, 6000, '-', 'G2', 'T2a'),
+    ('transcript', 5001, 6800, '-', 'G2', 'T2b'),
+    ('exon', 6501, 6800, '-', 'G2', 'T2b'),
+    ('exon', 5001, 5300, '-', 'G2', 'T2b'),
+    ('exon', 5551, 5700, '-', 'G2', 'T2b'),
+]
+
+def write_gtf(filename):
+    with open(filename, 'w') as fp:
+        for feature, start, end, strand, gene, transcript in GTF:
+            attributes = 'gene_id "{}";'.format(gene)
+            if transcript is not None:
+                attributes += ' transcript_id "{}";'.format(transcript)
+            fp.write('chr1\ttest\t{}\t{}\t{}\t.\t{}\t.\t{}\n'.format(feature, start, end, strand, attributes))
+
+def iter_molecules(transcripts):
+    # molecules covering one or two introns of every transcript, starting and ending at different depths in the flanking exons
+    for exons in transcripts.values():
+        exons = sorted(exons)
+        for a in range(len(exons)-1):
+            for b in range(a+1, min(len(exons), a+3)):
+                for first in [1, 3, 5, 6, 10, 50]:
+                    for last in [1, 3, 5, 6, 10, 50]:
+                        blocks = [list(e) for e in exons[a:b+1]]
+                        blocks[0][0] = blocks[0][1] - first + 1
+                        blocks[-1][1] = blocks[-1][0] + last - 1
+                        cigar = ''.join(['{}N{}M'.format(s - blocks[n-1][1] - 1, e - s + 1) if n > 0 else '{}M'.format(e - s + 1) for n, (s, e) in enumerate(blocks)])
+                        chain = ','.join(['{}-{}'.format(blocks[n-1][1] + 1, s - 1) for n, (s, e) in enumerate(blocks) if n > 0])
+                        yield blocks[0][0], cigar, sum([e - s + 1 for s, e in blocks]), chain
+
+def test_intron_chains_match_interval_lookup(tmp_path):
+    gtffile = str(tmp_path / 'genes.gtf')
+    write_gtf(gtffile)
+    files = {k: str(tmp_path / '{}.json'.format(k)) for k in ['intervals', 'refskip', 'chains']}
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(__file__), '..', 'gtf_to_json.py'), '-g', gtffile, '-d', str(tmp_path / 'genes.db'),
+                    '-ji', files['intervals'], '-jr', files['refskip'], '-jc', files['chains']], check=True, capture_output=True)
+    annotation = {}
+    for k, filename in files.items():
+        with open(filename) as fp:
+            annotation[k] = json.load(fp)
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 100000}]})
+    transcripts = {}
+    for feature, start, end, strand, gene, transcript in GTF:
+        if feature == 'exon':
+            transcripts.setdefault(gene, {}).setdefault(transcript, []).append((start, end))
+    n_chain = 0
+    for gene in ['G1', 'G2']:
+        isoform_dict, refskip_dict = stitcher.load_isoform_intervals(annotation['intervals'][gene], annotation['refskip'][gene])
+        intron_chains = annotation['chains'][gene]
+        for pos, cigar, length, chain in iter_molecules(transcripts[gene]):
+            mol = 'C:{}:U\t0\tchr1\t{}\t255\t{}\t*\t0\t0\t{}\t{}\tBC:Z:C\tXT:Z:{}\tUB:Z:U'.format(gene, pos, cigar, 'A'*length, 'I'*length, gene)
+            tags = []
+            for chains in [None, intron_chains]:
+                res = stitcher.assign_compatible_isoforms([(True, mol)], isoform_dict, refskip_dict, header, chains)
+                tags.append(set(pysam.AlignedSegment.fromstring(res[0][1], header).get_tag('CT').split(',')) if len(res) > 0 else None)
+            assert tags[0] == tags[1], (gene, pos, cigar)
+            n_chain += chain in intron_chains
+    assert n_chain > 0
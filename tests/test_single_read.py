@@ -0,0 +1,76 @@
+import os
+import sys
+import random
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import stitcher
+
+header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 100000}]})
+
+def random_cigar(rng, blocks):
+    # aligned blocks at the given reference intervals, joined by introns, with random deletions, insertions and soft clips
+    cigar = []
+    if rng.random() < 0.3:
+        cigar.append((4, rng.randint(1, 5)))
+    for n, (s, e) in enumerate(blocks):
+        if n > 0:
+            cigar.append((3, s - blocks[n-1][1] - 1))
+        length = e - s + 1
+        if length > 12 and rng.random() < 0.4:
+            x = rng.randint(3, length - 8)
+            op = rng.choice([1, 2])
+            k = rng.randint(1, 3)
+            if op == 2:
+                cigar += [(0, x), (2, k), (0, length - x - k)]
+            else:
+                cigar += [(0, x), (1, k), (0, length - x)]
+        else:
+            cigar.append((0, length))
+    if rng.random() < 0.3:
+        cigar.append((4, rng.randint(1, 5)))
+    return cigar
+
+def make_read(rng, name, flag, blocks):
+    cigar = random_cigar(rng, blocks)
+    length = sum([n for op, n in cigar if op in (0, 1, 4)])
+    cigarstring = ''.join(['{}{}'.format(n, 'MIDNS'[op]) for op, n in cigar])
+    seq = ''.join([rng.choice('ACGTTN' if rng.random() < 0.05 else 'ACGT') for i in range(length)])
+    qual = ''.join([chr(33 + rng.choice([2, 3, 11, 20, 25, 30, 37, 40])) for i in range(length)])
+    return pysam.AlignedSegment.fromstring('{}\t{}\tchr1\t{}\t255\t{}\t*\t0\t0\t{}\t{}\tBC:Z:C\tUB:Z:U\tGE:Z:G'.format(name, flag, blocks[0][0], cigarstring, seq, qual), header)
+
+def random_blocks(rng, start):
+    blocks = []
+    for i in range(rng.randint(1, 3)):
+        s = start if i == 0 else blocks[-1][1] + rng.randint(20, 200)
+        blocks.append((s, s + rng.randint(15, 60)))
+    return blocks
+
+def iter_groups(rng, n):
+    for i in range(n):
+        read1_blocks = random_blocks(rng, rng.randint(1000, 1100))
+        if rng.random() < 0.3:
+            yield [make_read(rng, 'r', rng.choice([0, 16]), read1_blocks)], True
+            continue
+        kind = rng.random()
+        if kind < 0.4:
+            # mates overlapping with the same introns
+            read2_blocks = read1_blocks[rng.randint(0, len(read1_blocks)-1):]
+        elif kind < 0.7:
+            # mates overlapping with different introns, aligned bases of one mate may fall into the intron of the other
+            read2_blocks = random_blocks(rng, read1_blocks[0][0] + rng.randint(0, 40))
+        else:
+            read2_blocks = random_blocks(rng, read1_blocks[-1][1] + rng.randint(1, 300))
+        flags = rng.choice([(99, 147), (83, 163)])
+        yield [make_read(rng, 'r', flags[0], read1_blocks), make_read(rng, 'r', flags[1], read2_blocks)], False
+
+def test_single_read_path_matches_general_path(monkeypatch):
+    rng = random.Random(1)
+    groups = list(iter_groups(rng, 1000))
+    fast = [stitcher.stitch_reads(reads, single_end, 'C', 'G', 'U', 'UB') for reads, single_end in groups]
+    n_fast = sum([stitcher.stitch_single_read(reads, single_end, 'C', 'G', 'U', 'UB') is not None for reads, single_end in groups])
+    monkeypatch.setattr(stitcher, 'stitch_single_read', lambda *args: None)
+    general = [stitcher.stitch_reads(reads, single_end, 'C', 'G', 'U', 'UB') for reads, single_end in groups]
+    for (reads, single_end), f, g in zip(groups, fast, general):
+        assert f == g, [r.to_string() for r in reads]
+    assert n_fast > 700
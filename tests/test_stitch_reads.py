@@ -0,0 +1,44 @@
+import os
+import sys
+import random
+import numpy as np
+import pysam
+from scipy.special import logsumexp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import stitcher
+
+def test_many_duplicate_spliced_reads():
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 100000}]})
+    reads = [pysam.AlignedSegment.fromstring('r{}\t0\tchr1\t1000\t255\t20M200N20M\t*\t0\t0\t{}\t{}\tUB:Z:U\tGE:Z:G'.format(i, 'ACGT'*10, 'I'*40), header) for i in range(40)]
+    success, mol = stitcher.stitch_reads(reads, True, 'C', 'G', 'U', 'UB')
+    assert success
+    fields = mol.split('\t')
+    assert fields[5] == '20M200N20M'
+    assert fields[9] == 'ACGT'*10
+    assert 'NR:i:40' in fields
+
+def test_duplicates_with_mixed_qualities():
+    # duplicates with different qualities plus a minority of reads disagreeing at two positions, one won by each side.
+    # Likelihood ties are avoided, since the order the duplicates are summed in may resolve those differently.
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 100000}]})
+    rng = random.Random(3)
+    seqs = ['ACGT'*10]*25 + ['ACGTACCTACGTACGTACGTTCGTACGTACGTACGTACGT']*10
+    reads = []
+    for i, seq in enumerate(seqs):
+        qual = [rng.choice([2, 7, 13, 21, 33]) if i < 25 else rng.choice([38, 41]) for k in range(40)]
+        reads.append(pysam.AlignedSegment.fromstring('r{}\t0\tchr1\t1000\t255\t20M200N20M\t*\t0\t0\t{}\t{}\tUB:Z:U\tGE:Z:G'.format(i, seq, ''.join([chr(q+33) for q in qual])), header))
+    expected_seq, expected_qual = '', []
+    for k in range(40):
+        ll = {b: sum([np.log(1-10**(-r.query_qualities[k]/10)) if r.query_sequence[k] == b else -r.query_qualities[k]*np.log(10)/10 - np.log(3) for r in reads]) for b in 'ATCG'}
+        best = max(ll, key=ll.get)
+        p = np.exp(ll[best] - logsumexp(list(ll.values())))
+        expected_seq += best if p > 0.3 else 'N'
+        expected_qual.append(min(93, int(np.rint(-10*np.log10(1-p+1e-13)))))
+    success, mol = stitcher.stitch_reads(reads, True, 'C', 'G', 'U', 'UB')
+    assert success
+    mol = pysam.AlignedSegment.fromstring(mol, header)
+    assert mol.cigarstring == '20M200N20M'
+    assert mol.query_sequence == expected_seq
+    assert expected_seq != 'ACGT'*10 and expected_seq != seqs[-1]
+    assert list(mol.query_qualities) == expected_qual